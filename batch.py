@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Score sample points listed in a manifest without starting the GUI.
+
+The manifest is a CSV file, or a JSON list of objects, with a row per
+point. Each row has the image 'path', 'x', 'y' and 'radius' in pixels,
+plus any Sample fields (genus, species, plumreg, ...) to copy into the
+output. Every image is decoded once and its points are scored together,
+with the images spread over a pool of worker processes.
+
+    python batch.py manifest.csv -o samples.csv
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+import fingerprint
+import histograms
+import image_io
+import patch_stats
+import sample
+import sample_store
+
+COLOUR_SPACES = tuple(patch_stats.COLOUR_SPACES)
+
+
+def read_manifest(file_name):
+    with open(file_name, newline='') as f:
+        if file_name.lower().endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    # Relative image paths are relative to the manifest
+    base = os.path.dirname(os.path.abspath(file_name))
+    for row in rows:
+        row['path'] = os.path.join(base, row['path'])
+    return rows
+
+
+def group_by_image(rows):
+    groups = collections.OrderedDict()
+    for row in rows:
+        groups.setdefault(row['path'], []).append(row)
+    return groups
+
+
+def region_stats(reader, xs, ys, radii, spaces=COLOUR_SPACES):
+    """Statistics in spaces, and HSV histograms, of the patch around each
+    point, read through an image_io.RegionReader.
+
+    Only the pixels of each patch are converted, so memory stays bounded
+    by the patch size whatever the size of the image. Histograms are None
+    unless spaces include 'hsv'.
+    """
+    channels = 3 * len(spaces)
+    parts, hists = [], []
+    for x, y, radius in zip(xs, ys, radii):
+        y1, y2, x1, x2 = box = patch_stats.patch_bounds(
+            x, y, radius, reader.shape)
+        region = reader.read(box)
+        planes = (
+            patch_stats.to_colour_spaces(region, spaces) if region.size else
+            np.zeros(region.shape[:2] + (channels,)))
+        parts.append(patch_stats.sample_patches(
+            planes, [x - x1], [y - y1], [radius]))
+        if 'hsv' in spaces:
+            hsv = 3 * spaces.index('hsv')
+            hists.append(histograms.pixel_histogram(
+                histograms.float_to_bins(planes[..., hsv:hsv + 3])))
+        else:
+            hists.append(None)
+    return patch_stats.PatchStats(
+        *[np.concatenate(field) for field in zip(*parts)]), hists
+
+
+def score_image(path, rows, spaces=COLOUR_SPACES):
+    """Return the CSV lines of Sample rows for the points of one image.
+
+    Only the statistics of spaces are computed; other colour space
+    columns keep the values given in rows.
+    """
+    digest = fingerprint.file_sha1(path)
+    xs = [int(row['x']) for row in rows]
+    ys = [int(row['y']) for row in rows]
+    radii = [int(row['radius']) for row in rows]
+    with image_io.RegionReader(path) as reader:
+        stats, hists = region_stats(reader, xs, ys, radii, spaces)
+
+    lines = []
+    for i, row in enumerate(rows):
+        s = sample.Sample()
+        for key, value in row.items():
+            if key in s.data:
+                s.data[key] = value
+        s.data['imgfile'] = os.path.basename(path)
+        s.data['imghash'] = digest
+        s.data['x'] = xs[i]
+        s.data['y'] = ys[i]
+        s.data['size'] = (radii[i] * 2) ** 2
+        s.data['method'] = 'square'
+        s.data['patches'] = 1
+        s.data['pixels'] = int(stats.count[i])
+        s.set_stats(patch_stats.stats_row(stats, i), spaces)
+        if hists[i] is not None:
+            s.set_histogram(hists[i])
+        lines.append(s.get_csv())
+    return lines
+
+
+def score_groups(groups, jobs=None, spaces=COLOUR_SPACES):
+    """Yield (path, lines or exception) for each image, in manifest order."""
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        futures = [
+            (path, executor.submit(score_image, path, rows, spaces))
+            for path, rows in groups.items()
+        ]
+        for path, future in futures:
+            try:
+                yield path, future.result()
+            except Exception as e:
+                yield path, e
+
+
+def write_output(file_name, lines):
+    head = sample.Sample().get_csv_head()
+    if file_name.lower().endswith('.csv'):
+        with open(file_name, 'w') as f:
+            f.write('{}\n'.format(head))
+            for line in lines:
+                f.write('{}\n'.format(line))
+    else:
+        store = sample_store.SampleStore()
+        store.extend_csv([head] + list(lines))
+        store.save(file_name)
+
+
+def colour_spaces(text):
+    """argparse type of a comma separated list of colour spaces."""
+    spaces = tuple(text.split(','))
+    for space in spaces:
+        if space not in patch_stats.COLOUR_SPACES:
+            raise argparse.ArgumentTypeError(
+                'unknown colour space {!r}, expected some of {}'.format(
+                    space, ','.join(patch_stats.COLOUR_SPACES)))
+    return spaces
+
+
+def add_spaces_argument(parser):
+    parser.add_argument(
+        '--spaces', type=colour_spaces, default=COLOUR_SPACES,
+        help='colour spaces to compute (default: {}); HSV percentiles '
+             'and histograms need hsv'.format(','.join(COLOUR_SPACES)))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('manifest', help='CSV or JSON list of points')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='output file (.csv, .npz or .parquet)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='worker processes (default: one per CPU)')
+    add_spaces_argument(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    groups = group_by_image(read_manifest(args.manifest))
+    failed = 0
+
+    def scored_lines():
+        nonlocal failed
+        for path, result in score_groups(groups, args.jobs, args.spaces):
+            if isinstance(result, Exception):
+                failed += 1
+                sys.stderr.write('{}: {}\n'.format(path, result))
+            else:
+                yield from result
+
+    write_output(args.output, scored_lines())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
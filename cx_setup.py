@@ -20,5 +20,9 @@ setup(
     options={
         'build_exe': build_exe_options,
     },
-    executables=[Executable('main.py', base=base)],
+    executables=[
+        Executable('main.py', base=base),
+        Executable('batch.py'),
+        Executable('resample.py'),
+    ],
 )
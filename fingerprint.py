@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import threading
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+# Hashes of the images of a folder are kept in this file inside it
+INDEX_FILE = '.digbird_fingerprints.json'
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_images(directory):
+    """Yield the paths of all image files below directory.
+
+    Symbolic links to directories are followed, but each directory is
+    scanned only once, so that link cycles end.
+    """
+    stack = [directory]
+    visited = set()
+    while stack:
+        path = stack.pop()
+        stat = os.stat(path)
+        if (stat.st_dev, stat.st_ino) in visited:
+            continue
+        visited.add((stat.st_dev, stat.st_ino))
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield entry.path
+
+
+class FingerprintIndex(object):
+    """Content hashes of files, recomputed only when mtime or size change.
+
+    With a file_name the hashes are kept on disk between runs. Hashes
+    may be looked up and recorded from several threads.
+    """
+
+    def __init__(self, file_name=None):
+        self.file_name = file_name
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if file_name is not None and os.path.exists(file_name):
+            with open(file_name) as f:
+                self.entries = json.load(f)
+
+    def digest(self, path):
+        digest = self.cached(path)
+        if digest is None:
+            digest = file_sha1(path)
+            self.record(path, digest)
+        return digest
+
+    def cached(self, path):
+        """Hash of path if known for its current mtime and size, or None."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None or entry[:2] != [st.st_mtime_ns, st.st_size]:
+            return None
+        return entry[2]
+
+    def record(self, path, digest):
+        """Store a hash of path computed elsewhere, such as in a worker."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            self.entries[path] = [st.st_mtime_ns, st.st_size, digest]
+            self.dirty = True
+
+    def save(self):
+        if self.file_name is None or not self.dirty:
+            return
+        tmp_file = self.file_name + '.tmp'
+        with self.lock:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.entries, f)
+            self.dirty = False
+        os.replace(tmp_file, self.file_name)
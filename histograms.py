@@ -0,0 +1,106 @@
+import numpy as np
+
+import plane_cache
+
+# Bins per HSV channel of the index; percentiles are interpolated within
+# a bin of 1 / INDEX_BINS
+INDEX_BINS = 128
+# Bins per channel of the histograms stored with samples
+HIST_BINS = 16
+PERCENTILES = (5, 25, 50, 75, 95)
+# Side in pixels of the tiles whose histograms the index sums up
+TILE_SIZE = 32
+# Bits dropped from quantized HSV values to get an index bin
+BIN_SHIFT = 16 - int(np.log2(INDEX_BINS))
+
+
+def to_bins(hsv):
+    """Index bins of quantized uint16 HSV pixels."""
+    return np.right_shift(hsv, BIN_SHIFT).astype(np.intp)
+
+
+def float_to_bins(hsv):
+    """Index bins of HSV pixels in [0, 1], as for the quantized planes."""
+    return to_bins(plane_cache.quantize(hsv))
+
+
+def pixel_histogram(bins):
+    """(3, INDEX_BINS) counts of an (..., 3) array of bins."""
+    flat = (bins.reshape(-1, 3) + np.arange(3) * INDEX_BINS).ravel()
+    return np.bincount(flat, minlength=3 * INDEX_BINS).reshape(3, -1)
+
+
+def percentiles(hist, qs=PERCENTILES):
+    """(3, len(qs)) percentiles in [0, 1] of (3, INDEX_BINS) counts.
+
+    Values are spread evenly within each bin, as by linear interpolation
+    of the cumulative histogram.
+    """
+    cum = np.cumsum(hist, axis=1)
+    targets = np.asarray(qs, dtype=np.float64) / 100 * cum[:, -1:]
+    # Bin holding each target, and the count of the bins before it
+    index = np.minimum(
+        (cum[:, np.newaxis, :] < targets[:, :, np.newaxis]).sum(axis=2),
+        INDEX_BINS - 1)
+    before = np.where(
+        index > 0, np.take_along_axis(cum, np.maximum(index - 1, 0), 1), 0)
+    inside = np.take_along_axis(hist, index, 1)
+    fraction = (targets - before) / np.maximum(inside, 1)
+    return (index + np.clip(fraction, 0, 1)) / INDEX_BINS
+
+
+def coarsen(hist, bins=HIST_BINS):
+    """Sum (3, INDEX_BINS) counts into (3, bins) counts."""
+    return hist.reshape(3, bins, -1).sum(axis=2)
+
+
+class HistogramIndex(object):
+    """Cumulative tile histograms of the quantized HSV planes of an image.
+
+    The histogram of any box is the sum of the whole tiles it covers,
+    found from the cumulative table in constant time, plus a bincount of
+    the pixels in the partial tiles along its border. Percentiles then
+    follow from the histogram without sorting any pixels.
+    """
+
+    def __init__(self, hsv):
+        self.hsv = hsv
+        height, width = hsv.shape[:2]
+        rows, cols = height // TILE_SIZE, width // TILE_SIZE
+        self.table = np.zeros(
+            (rows + 1, cols + 1, 3, INDEX_BINS), dtype=np.uint32)
+        offsets = np.arange(3) * INDEX_BINS
+        for row in range(rows):
+            band = hsv[row * TILE_SIZE:(row + 1) * TILE_SIZE,
+                       :cols * TILE_SIZE]
+            tiles = np.arange(band.shape[1]) // TILE_SIZE
+            flat = (tiles[np.newaxis, :, np.newaxis] * 3 * INDEX_BINS +
+                    offsets + to_bins(band)).ravel()
+            counts = np.bincount(flat, minlength=cols * 3 * INDEX_BINS)
+            self.table[row + 1, 1:] = counts.reshape(cols, 3, INDEX_BINS)
+        np.cumsum(self.table, axis=0, out=self.table)
+        np.cumsum(self.table, axis=1, out=self.table)
+
+    def query(self, bounds):
+        """(3, INDEX_BINS) histogram of the (y1, y2, x1, x2) box."""
+        y1, y2, x1, x2 = bounds
+        # Whole tiles inside the box
+        ty1, ty2 = -(-y1 // TILE_SIZE), y2 // TILE_SIZE
+        tx1, tx2 = -(-x1 // TILE_SIZE), x2 // TILE_SIZE
+        if ty1 >= ty2 or tx1 >= tx2:
+            return pixel_histogram(to_bins(self.hsv[y1:y2, x1:x2]))
+        t = self.table
+        hist = (t[ty2, tx2].astype(np.int64) - t[ty1, tx2] - t[ty2, tx1] +
+                t[ty1, tx1])
+        iy1, iy2 = ty1 * TILE_SIZE, ty2 * TILE_SIZE
+        ix1, ix2 = tx1 * TILE_SIZE, tx2 * TILE_SIZE
+        border = [
+            self.hsv[y1:iy1, x1:x2],
+            self.hsv[iy2:y2, x1:x2],
+            self.hsv[iy1:iy2, x1:ix1],
+            self.hsv[iy1:iy2, ix2:x2],
+        ]
+        for strip in border:
+            if strip.size:
+                hist += pixel_histogram(to_bins(strip))
+        return hist
@@ -0,0 +1,161 @@
+import collections
+import concurrent.futures
+import threading
+
+import matplotlib.image as mpimg
+import numpy as np
+
+import histograms
+import patch_stats
+import plane_cache
+import pyramid
+
+
+def resident_bytes(array):
+    """Bytes of array held in RAM; memory-mapped planes count for none."""
+    if array is None or isinstance(array, np.memmap):
+        return 0
+    return array.nbytes
+
+
+class LoadedImage(collections.namedtuple('LoadedImage', [
+        'path', 'digest', 'img', 'hsv', 'index', 'histograms', 'pyramid'])):
+    """An image ready for sampling, with its indexes and pyramid."""
+
+    @property
+    def nbytes(self):
+        nbytes = resident_bytes(self.img) + resident_bytes(self.hsv)
+        if self.index is not None:
+            nbytes += self.index.sums.nbytes + self.index.squares.nbytes
+        nbytes += self.histograms.table.nbytes
+        # The first level of the pyramid is the image itself
+        return nbytes + sum(level.nbytes for level in self.pyramid[1:])
+
+
+def load_image(planes_cache, fingerprints, path, cancelled=lambda: False):
+    """Load the planes of path and build its sampling indexes.
+
+    Returns None as soon as cancelled() reports that the result is no
+    longer wanted, skipping the remaining work.
+    """
+    digest = fingerprints.digest(path)
+    planes = planes_cache.load(path, digest)
+    if cancelled():
+        return None
+    levels = pyramid.build_pyramid(planes.rgb)
+    if cancelled():
+        return None
+    # The summed-area tables take 48 bytes per pixel; without them patches
+    # are reduced pixel by pixel
+    try:
+        index = patch_stats.PatchIndex(planes.hsv, plane_cache.HSV_SCALE)
+    except MemoryError:
+        index = None
+    if cancelled():
+        return None
+    hist_index = histograms.HistogramIndex(planes.hsv)
+    return LoadedImage(
+        path, digest, planes.rgb, planes.hsv, index, hist_index, levels)
+
+
+class ImageCache(object):
+    """Thread-safe LRU cache of decoded images bounded by total bytes.
+
+    Values are whatever loader returns, as long as they have an nbytes
+    attribute, such as arrays or LoadedImage. Extra arguments of get are
+    passed on to loader; a None result, as from a cancelled load, is
+    returned but not cached.
+    """
+
+    def __init__(self, max_bytes, loader=mpimg.imread):
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.nbytes = 0
+        self.entries = collections.OrderedDict()
+        # Loads in progress, so that a path is never decoded twice at once
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, path):
+        with self.lock:
+            return path in self.entries
+
+    def get(self, path, *args):
+        with self.lock:
+            if path in self.entries:
+                self.entries.move_to_end(path)
+                return self.entries[path]
+            future = self.pending.get(path)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self.pending[path] = future
+        if not owner:
+            return future.result()
+
+        try:
+            img = self.loader(path, *args)
+        except Exception as e:
+            with self.lock:
+                del self.pending[path]
+            future.set_exception(e)
+            raise
+        # Cached arrays are shared between callers
+        if hasattr(img, 'flags'):
+            img.flags.writeable = False
+        with self.lock:
+            del self.pending[path]
+            if img is not None:
+                self._store(path, img)
+        future.set_result(img)
+        return img
+
+    def _store(self, path, img):
+        if img.nbytes > self.max_bytes:
+            return
+        self.entries[path] = img
+        self.nbytes += img.nbytes
+        while self.nbytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+class Prefetcher(object):
+    """Loads the neighbours of the current file in a background thread.
+
+    Loads go through the cache, so that its loader builds the complete
+    LoadedImage of each neighbour before it is shown.
+    """
+
+    def __init__(self, cache, ahead=2, behind=1):
+        self.cache = cache
+        self.ahead = ahead
+        self.behind = behind
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.futures = {}
+
+    def update(self, files, index):
+        wanted = (
+            files[index + 1:index + 1 + self.ahead] +
+            files[max(index - self.behind, 0):index][::-1]
+        )
+        for path, future in list(self.futures.items()):
+            if path not in wanted:
+                future.cancel()
+            if future.done() or path not in wanted:
+                del self.futures[path]
+        for path in wanted:
+            if path not in self.futures and path not in self.cache:
+                self.futures[path] = self.executor.submit(
+                    self.cache.get, path)
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,146 @@
+import matplotlib.image as mpimg
+import numpy as np
+
+import image_cache
+import plane_cache
+import pyramid
+
+# Optional decoders for partial reads; without them whole images are
+# decoded and cached
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+FULL_DECODE_CACHE_BYTES = 256 * 1024 ** 2
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def decode(path):
+    return plane_cache.to_uint8_rgb(mpimg.imread(path))
+
+
+full_decodes = image_cache.ImageCache(FULL_DECODE_CACHE_BYTES, decode)
+
+
+def read_image(path):
+    """Whole image as uint8 RGB, through a small shared decode cache."""
+    return full_decodes.get(path)
+
+
+def image_shape(path):
+    """(height, width) of an image, read from its header when possible."""
+    if tifffile is not None and path.lower().endswith(TIFF_EXTENSIONS):
+        with tifffile.TiffFile(path) as tif:
+            page = tif.pages[0]
+            return page.imagelength, page.imagewidth
+    if Image is not None:
+        with Image.open(path) as im:
+            return im.height, im.width
+    return read_image(path).shape[:2]
+
+
+def read_region(path, box):
+    """uint8 RGB pixels of box = (y1, y2, x1, x2), as from patch_bounds."""
+    with RegionReader(path) as reader:
+        return reader.read(box)
+
+
+class RegionReader(object):
+    """Reads regions of one image, parsing its file only once.
+
+    Tiled TIFF files are kept open and only have the tiles overlapping
+    each region decoded; other images are decoded whole on the first read
+    and kept until the reader is closed, however large they are.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tif = None
+        self.page = None
+        self.img = None
+        if tifffile is not None and path.lower().endswith(TIFF_EXTENSIONS):
+            self.tif = tifffile.TiffFile(path)
+            page = self.tif.pages[0]
+            self.shape = (page.imagelength, page.imagewidth)
+            self.page = _tiled_page(self.tif)
+            if self.page is None:
+                self.close()
+        else:
+            self.shape = image_shape(path)
+
+    @property
+    def tiled(self):
+        return self.page is not None
+
+    def read(self, box):
+        if self.tiled:
+            return _read_tiles(self.tif, self.page, box)
+        if self.img is None:
+            self.img = read_image(self.path)
+        y1, y2, x1, x2 = box
+        return self.img[y1:y2, x1:x2]
+
+    def close(self):
+        self.img = None
+        if self.tif is not None:
+            self.tif.close()
+            self.tif = None
+            self.page = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_preview(path, max_size):
+    """Image scaled to fit in max_size pixels, decoded at reduced size.
+
+    JPEG files are decoded directly at 1/2, 1/4 or 1/8 scale when that is
+    still at least max_size.
+    """
+    if Image is not None:
+        with Image.open(path) as im:
+            im.draft('RGB', (max_size, max_size))
+            im = im.convert('RGB')
+            im.thumbnail((max_size, max_size))
+            return np.asarray(im)
+    levels = pyramid.build_pyramid(read_image(path), max_size)
+    return levels[-1]
+
+
+def _tiled_page(tif):
+    page = tif.pages[0]
+    if (page.is_tiled and page.imagedepth == 1 and
+            page.planarconfig == 1 and page.samplesperpixel >= 3):
+        return page
+    return None
+
+
+def _read_tiles(tif, page, box):
+    y1, y2, x1, x2 = box
+    th, tw = page.tilelength, page.tilewidth
+    across = -(-page.imagewidth // tw)
+    region = np.zeros(
+        (y2 - y1, x2 - x1, page.samplesperpixel), dtype=page.dtype)
+    fh = tif.filehandle
+    for ty in range(y1 // th, (y2 - 1) // th + 1):
+        for tx in range(x1 // tw, (x2 - 1) // tw + 1):
+            index = ty * across + tx
+            fh.seek(page.dataoffsets[index])
+            data = fh.read(page.databytecounts[index])
+            tile = page.decode(data, index, jpegtables=page.jpegtables)[0]
+            if tile is None:
+                continue
+            tile = tile.reshape(th, tw, -1)
+            oy1, oy2 = max(y1, ty * th), min(y2, (ty + 1) * th)
+            ox1, ox2 = max(x1, tx * tw), min(x2, (tx + 1) * tw)
+            region[oy1 - y1:oy2 - y1, ox1 - x1:ox2 - x1] = tile[
+                oy1 - ty * th:oy2 - ty * th, ox1 - tx * tw:ox2 - tx * tw]
+    return plane_cache.to_uint8_rgb(region)
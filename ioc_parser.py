@@ -1,58 +1,187 @@
+import collections
+import hashlib
+import os
+import pickle
 import xml.etree.ElementTree as ET
 
+# Bump when the layout of the pickled taxonomy changes
+CACHE_VERSION = 1
+
+RANKS = ('order', 'family', 'genus', 'species', 'subspecies')
+
+Species = collections.namedtuple('Species', ['english_name', 'subspecies'])
+
+
+def file_sha1(file_name):
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
 
 class IOC(object):
-    def __init__(self):
-        self.file_name = 'data/ioc.xml'
-        self.tree = ET.parse(self.file_name)
-        self.root = self.tree.getroot()
-        self.root_list = self.root.find('./list')
+    def __init__(self, file_name='data/ioc.xml'):
+        self.file_name = file_name
+        self.cache_file = os.path.splitext(file_name)[0] + '.pickle'
+
+        # order -> family -> [genus], and genus -> species -> Species, all
+        # keyed by latin name and kept in the order of the master list
+        self.orders = collections.OrderedDict()
+        self.genera = collections.OrderedDict()
+        if not self.load_cache():
+            self.parse()
+            self.save_cache()
+
+    def parse(self):
+        """Stream the XML file into the index.
+
+        Elements are cleared as soon as their names have been recorded, so
+        the document tree is never held in memory as a whole.
+        """
+        # Latin name of the innermost open element of each rank
+        names = {}
+        path = []
+        for event, elem in ET.iterparse(self.file_name, ('start', 'end')):
+            if event == 'start':
+                path.append(elem.tag)
+                continue
+            path.pop()
+            parent = path[-1] if path else None
+            if elem.tag == 'latin_name' and parent in RANKS:
+                names[parent] = elem.text
+                self.add_name(parent, names)
+            elif elem.tag == 'english_name' and parent == 'species':
+                genus = self.genera[names['genus']]
+                genus[names['species']] = genus[names['species']]._replace(
+                    english_name=elem.text)
+            elif elem.tag in RANKS or elem.tag == 'list':
+                elem.clear()
+
+    def add_name(self, rank, names):
+        if rank == 'order':
+            self.add_order(names['order'])
+        elif rank == 'family':
+            self.add_family(names['order'], names['family'])
+        elif rank == 'genus':
+            self.add_genus(names['order'], names['family'], names['genus'])
+        elif rank == 'species':
+            self.add_species(names['genus'], names['species'], None)
+        elif rank == 'subspecies':
+            self.add_subspecies(
+                names['genus'], names['species'], names['subspecies'])
+
+    def stamp(self):
+        st = os.stat(self.file_name)
+        return st.st_mtime_ns, st.st_size
+
+    def load_cache(self):
+        """Fill the index from the cache file if it matches the XML file.
+
+        A changed mtime or size alone does not invalidate the cache as long
+        as the content hash is unchanged.
+        """
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cache = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+        if cache.get('version') != CACHE_VERSION:
+            return False
+        if cache['stamp'] != self.stamp():
+            sha1 = file_sha1(self.file_name)
+            if cache['sha1'] != sha1:
+                return False
+            cache['stamp'] = self.stamp()
+            self.write_cache(cache)
+
+        for order, families in cache['orders']:
+            self.add_order(order)
+            for family, genera in families:
+                self.add_family(order, family)
+                for genus in genera:
+                    self.add_genus(order, family, genus)
+        for genus, species in cache['genera']:
+            for sp, english_name, subspecies in species:
+                self.add_species(genus, sp, english_name)
+                self.genera[genus][sp].subspecies.extend(subspecies)
+        return True
+
+    def save_cache(self):
+        self.write_cache({
+            'version': CACHE_VERSION,
+            'stamp': self.stamp(),
+            'sha1': file_sha1(self.file_name),
+            'orders': [
+                (order, list(families.items()))
+                for order, families in self.orders.items()
+            ],
+            'genera': [
+                (genus, [
+                    (sp, entry.english_name, entry.subspecies)
+                    for sp, entry in species.items()
+                ])
+                for genus, species in self.genera.items()
+            ],
+        })
+
+    def write_cache(self, cache):
+        # The data directory may be read-only in frozen installs, in which
+        # case the taxonomy is simply parsed again on the next start
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.cache_file)
+        except OSError:
+            pass
+
+    def add_order(self, order):
+        self.orders.setdefault(order, collections.OrderedDict())
+
+    def add_family(self, order, family):
+        self.orders[order].setdefault(family, [])
+
+    def add_genus(self, order, family, genus):
+        self.orders[order][family].append(genus)
+        self.genera.setdefault(genus, collections.OrderedDict())
+
+    def add_species(self, genus, species, english_name):
+        self.genera[genus][species] = Species(english_name, [])
+
+    def add_subspecies(self, genus, species, subspecies):
+        self.genera[genus][species].subspecies.append(subspecies)
+
+    def _families(self, order=None):
+        if order is None or order == 'ALL':
+            return list(self.orders.values())
+        if order in self.orders:
+            return [self.orders[order]]
+        return []
 
     def get_orders(self):
-        orders = self.root_list.findall('./order')
-        return [o.find('latin_name').text for o in orders]
+        return list(self.orders)
 
     def get_families(self, order=None):
-        if order is None or order == 'ALL':
-            families = self.root_list.findall('./order/family')
-        else:
-            families = self.root_list.findall(
-                './order[latin_name="{}"]/family'.format(order))
-        return [f.find('latin_name').text for f in families]
+        return [f for families in self._families(order) for f in families]
 
     def get_species(self, order=None, family=None):
         result = []
-        xpath = '.'
-        if order is None or order == 'ALL':
-            xpath += '/order'
-        else:
-            xpath += '/order[latin_name="{}"]'.format(order)
-        if family is None or family == 'ALL':
-            xpath += '/family'
-        else:
-            xpath += '/family[latin_name="{}"]'.format(family)
-        xpath += '/genus'
-        genera = self.root_list.findall(xpath)
-        for genus in genera:
-            genus_name = genus.find('latin_name').text
-            species = genus.findall('./species')
-            for sp in species:
-                sp_lat_name = sp.find('latin_name').text
-                sp_eng_name = sp.find('english_name').text
-                result.append(
-                    ('{} {}'.format(genus_name, sp_lat_name), sp_eng_name))
+        for families in self._families(order):
+            if family is None or family == 'ALL':
+                genera = [g for gs in families.values() for g in gs]
+            else:
+                genera = families.get(family, [])
+            for genus_name in genera:
+                for sp_lat_name, sp in self.genera[genus_name].items():
+                    result.append((
+                        '{} {}'.format(genus_name, sp_lat_name),
+                        sp.english_name,
+                    ))
         return result
 
     def get_subspecies(self, genus, species):
-        result = []
-        xpath = (
-            './order/family'
-            '/genus[latin_name="{}"]'
-            '/species[latin_name="{}"]'
-            '/subspecies'
-        ).format(genus, species)
-        ssps = self.root_list.findall(xpath)
-        for ssp in ssps:
-            ssp_lat_name = ssp.find('latin_name').text
-            result.append(ssp_lat_name)
-        return result
+        sp = self.genera.get(genus, {}).get(species)
+        if sp is None:
+            return []
+        return list(sp.subspecies)
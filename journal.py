@@ -0,0 +1,80 @@
+import os
+import time
+
+
+class SampleJournal(object):
+    """Append-only CSV file of inserted samples that survives crashes.
+
+    Rows are buffered and written in batches, each batch followed by an
+    fsync, so at most flush_rows rows or flush_seconds of work are lost if
+    the process dies. A journal left non-empty by a previous session holds
+    samples that were never saved and can be recovered.
+    """
+
+    def __init__(self, path, header, flush_rows=20, flush_seconds=5.0):
+        self.path = path
+        self.header = header
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.file = None
+        self.last_flush = time.monotonic()
+        # Journal of an older column layout, moved aside instead of mixed
+        self.stale_file = None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.count = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                if f.readline().rstrip('\n') != header:
+                    self.stale_file = '{}.{}'.format(
+                        path, time.strftime('%y%m%d%H%M%S'))
+                else:
+                    self.count = sum(1 for _ in f)
+            if self.stale_file is not None:
+                os.replace(path, self.stale_file)
+
+    def append(self, row):
+        self.pending.append(row)
+        self.count += 1
+        if (len(self.pending) >= self.flush_rows or
+                time.monotonic() - self.last_flush >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        if self.file is None:
+            new = not os.path.exists(self.path)
+            self.file = open(self.path, 'a')
+            if new:
+                self.file.write('{}\n'.format(self.header))
+        self.file.write(''.join('{}\n'.format(row) for row in self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+
+    def lines(self):
+        """Yield the header followed by every journaled row."""
+        self.flush()
+        yield self.header
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            f.readline()
+            for line in f:
+                yield line.rstrip('\n')
+
+    def clear(self):
+        self.close()
+        self.pending = []
+        self.count = 0
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
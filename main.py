@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
+import startup_clock  # first, to time the imports below
+
 import sys
 import os
-import collections
+import time
+import concurrent.futures
 import datetime
+import collections
+import multiprocessing
 
 from PyQt4 import QtGui
 from PyQt4 import QtCore
@@ -16,21 +21,39 @@ from PyQt4 import QtCore
 
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg
 from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
+from matplotlib.figure import Figure
+import matplotlib.patches
 import numpy as np
-import skimage.color
 
+import fingerprint
+import histograms
+import image_cache
 import ioc_parser
+import journal
+import name_index
+import patch_stats
+import plane_cache
+import pyramid
+import sample
+import sample_db
+import superpixels
 
 SPECIES_FILE = 'data/ploceide_taxon.csv'
 PLUMREG_FILE = 'data/plumreg.csv'
 
 
+# SLIC superpixel sampling; neighbouring superpixels are merged when their
+# mean colours are less than THRESHOLD apart in 0-255 RGB
 COMPACTNESS = 35
 N_SEGMENTS = 200
 THRESHOLD = 30
 
+# Colour spaces sampled besides HSV, from patch_stats.COLOUR_SPACES. HSV
+# comes from the plane cache, the others are converted from the pixels of
+# each patch
+EXTRA_COLOUR_SPACES = ('lab', 'linrgb')
+COLOUR_SPACES = ('hsv',) + EXTRA_COLOUR_SPACES
+
 CURSOR_COLOR = 'black'
 START_COLOR = [255, 255, 255]
 START_RADIUS = 10
@@ -39,25 +62,72 @@ MAX_RADIUS = 100
 RADIUS_SCROLL_DELTA = 5
 
 DISPLAY_PYPLOT_TOOLBAR = True
+# Repaint requests arriving within one frame are merged into one refresh
+REFRESH_INTERVAL_MS = 16
+
+# Memory budget for loaded images, with their sampling indexes, kept around
+# for paging back and forth; the indexes of a 12 MP image take about 600 MB
+IMAGE_CACHE_BYTES = 2 * 1024 ** 3
+# Filmstrip thumbnails kept in memory, and their side in pixels
+THUMBNAIL_MEMORY = 2000
+THUMBNAIL_SIZE = 128
+PREFETCH_AHEAD = 2
+PREFETCH_BEHIND = 1
+
+# Inserted samples are journaled here until they are saved
+JOURNAL_FILE = os.path.expanduser('~/.digbird/journal.csv')
+JOURNAL_FLUSH_ROWS = 20
+JOURNAL_FLUSH_MS = 5000
+# Saved samples from every session are collected here
+DATABASE_FILE = os.path.expanduser('~/.digbird/samples.sqlite')
+
+# Set to print how long each startup phase took; run with
+# `python -X importtime main.py` for a per-module breakdown of the imports
+PROFILE_STARTUP = bool(os.environ.get('DIGBIRD_PROFILE_STARTUP'))
+
+
+def log_startup(phase):
+    if PROFILE_STARTUP:
+        sys.stderr.write('startup: {:<12} {:8.1f} ms\n'.format(
+            phase,
+            (time.perf_counter() - startup_clock.STARTUP_CLOCK) * 1000))
+
+
+log_startup('imports')
 
 
 class Cursor(object):
+    """Outline of the sampled patch, blitted over a cached background.
+
+    Moving the cursor only restores the background saved after the last
+    full draw and redraws the outline, so the image itself is rendered
+    again only after a pan, zoom or image change.
+    """
+
     def __init__(self, ax):
+        # The square is only drawn when sampling squares
+        self.enabled = True
         self.reset(ax)
 
     def reset(self, ax):
         self.ax = ax
         self.x, self.y = 0, 0
         self.radius = START_RADIUS
+        self.background = None
+
+        self.footprint = matplotlib.patches.Rectangle(
+            (0, 0), 0, 0, fill=False, color=CURSOR_COLOR,
+            animated=True, visible=False)
+        ax.add_patch(self.footprint)
 
-        self.lx1 = ax.axhline(color=CURSOR_COLOR)
-        self.lx2 = ax.axhline(color=CURSOR_COLOR)
-        self.ly1 = ax.axvline(color=CURSOR_COLOR)
-        self.ly2 = ax.axvline(color=CURSOR_COLOR)
+    def on_draw(self, event):
+        self.background = event.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.footprint)
 
     def mouse_move(self, event):
-        if event.inaxes:
+        if event.inaxes is self.ax:
             self.x, self.y = int(event.xdata), int(event.ydata)
+            self.footprint.set_visible(self.enabled)
             self.update()
 
     def mouse_scroll(self, event):
@@ -68,72 +138,102 @@ class Cursor(object):
         self.update()
 
     def update(self):
-        self.lx1.set_ydata(self.y - self.radius)
-        self.lx2.set_ydata(self.y + self.radius)
-        self.ly1.set_xdata(self.x - self.radius)
-        self.ly2.set_xdata(self.x + self.radius)
+        # Outline the pixels patch_stats.patch_bounds samples, edge to edge
+        if self.radius <= 0:
+            x1, y1, side = self.x, self.y, 1
+        else:
+            x1 = self.x - self.radius + patch_stats.PATCH_OFFSET
+            y1 = self.y - self.radius + patch_stats.PATCH_OFFSET
+            side = 2 * self.radius
+        self.footprint.set_bounds(x1 - 0.5, y1 - 0.5, side, side)
+        self.blit()
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            self.footprint.set_visible(False)
+            self.blit()
+
+    def blit(self):
+        if self.background is None:
+            return
+        canvas = self.ax.figure.canvas
+        canvas.restore_region(self.background)
+        self.ax.draw_artist(self.footprint)
+        canvas.blit(self.ax.bbox)
 
 
-class Sample(object):
-    def __init__(self):
-        self.data = collections.OrderedDict()
-        self.data['genus'] = ''
-        self.data['species'] = ''
-        self.data['subspecies'] = ''
-        self.data['plumreg'] = ''
-        self.data['sex'] = ''
-        self.data['age'] = ''
-        self.data['colcat'] = ''
-        self.data['imgfile'] = ''
-        self.data['imgsrc'] = ''
-        self.data['imgtype'] = ''
-        self.data['x'] = 0
-        self.data['y'] = 0
-        self.data['size'] = 0
-        self.data['h_mean'] = 0
-        self.data['s_mean'] = 0
-        self.data['v_mean'] = 0
-        self.data['h_std'] = 0
-        self.data['s_std'] = 0
-        self.data['v_std'] = 0
-        self.data['h_min'] = 0
-        self.data['s_min'] = 0
-        self.data['v_min'] = 0
-        self.data['h_max'] = 0
-        self.data['s_max'] = 0
-        self.data['v_max'] = 0
-
-    def get_csv_head(self):
-        return ','.join(map(str, self.data.keys()))
-
-    def get_csv(self):
-        return ','.join(map(str, self.data.values()))
-
-    def get_display(self):
-        result = []
-        display_items = [
-            'x',
-            'y',
-            'size',
-            'h_mean',
-            's_mean',
-            'v_mean',
-            'h_std',
-            's_std',
-            'v_std',
-            'h_min',
-            's_min',
-            'v_min',
-            'h_max',
-            's_max',
-            'v_max',
-        ]
-        for i in display_items:
-            result.append((i, self.data.get(i)))
-        return result
+class ImageLoader(QtCore.QObject):
+    """Loads images on a worker thread, delivering only the latest request.
+
+    Every request supersedes the previous ones: queued loads are cancelled,
+    a load already running stops between steps, and results of stale
+    requests are never emitted.
+    """
+    loaded = QtCore.pyqtSignal(int, object)
+    segmented = QtCore.pyqtSignal(int, object)
+    failed = QtCore.pyqtSignal(int, str)
+
+    def __init__(self, cache, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Superpixels are computed on request on a thread of their own, so
+        # that they never hold up the next image
+        self.segmenter = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.generation = 0
+        self.future = None
+
+    def request(self, path):
+        self.generation += 1
+        if self.future is not None:
+            self.future.cancel()
+        self.future = self.executor.submit(self.load, self.generation, path)
+        return self.generation
+
+    def load(self, generation, path):
+        def cancelled():
+            return generation != self.generation
+        try:
+            loaded = self.cache.get(path, cancelled)
+        except Exception as e:
+            self.failed.emit(generation, '{}: {}'.format(path, e))
+            return
+        if loaded is not None and not cancelled():
+            self.loaded.emit(generation, loaded)
+
+    def request_segments(self, loaded):
+        """Compute the superpixels of the latest image, once delivered."""
+        self.segmenter.submit(self.segment, self.generation, loaded)
+
+    def segment(self, generation, loaded):
+        def cancelled():
+            return generation != self.generation
+        if cancelled():
+            return
+        try:
+            table = superpixels.load_segments(
+                loaded.pyramid, loaded.digest, loaded.hsv, N_SEGMENTS,
+                COMPACTNESS, EXTRA_COLOUR_SPACES, cancelled=cancelled)
+        except Exception as e:
+            self.failed.emit(generation, 'superpixels of {}: {}'.format(
+                loaded.path, e))
+            return
+        if table is not None and not cancelled():
+            self.segmented.emit(generation, table)
+
+    def shutdown(self):
+        self.generation += 1
+        if self.future is not None:
+            self.future.cancel()
+        self.executor.shutdown(wait=False)
+        self.segmenter.shutdown(wait=False)
 
 
 class MainWindow(QtGui.QMainWindow):
+    folder_scanned = QtCore.pyqtSignal(str, object)
+    folder_failed = QtCore.pyqtSignal(str, str)
+
     def __init__(self):
         super().__init__()
         styleName = 'Cleanlooks'
@@ -154,17 +254,44 @@ class MainWindow(QtGui.QMainWindow):
         self.load_dir = os.path.expanduser('~/Desktop')
         self.save_dir = os.path.expanduser('~/Desktop')
 
-        self.figure, self.ax = plt.subplots()
+        self.figure = Figure()
+        self.ax = self.figure.add_subplot(111)
         self.ax.get_xaxis().set_visible(False)
         self.ax.get_yaxis().set_visible(False)
         self.cursor = Cursor(self.figure.axes[0])
         self.file_index = 0
         self.files = []
-
-        self.data = []
-
-        self.sample = Sample()
+        self.fingerprints = fingerprint.FingerprintIndex()
+        # Decoding and colour conversion go through the on-disk plane cache
+        self.planes = plane_cache.PlaneCache()
+        self.image_cache = image_cache.ImageCache(
+            IMAGE_CACHE_BYTES, self.load_image)
+        self.prefetcher = image_cache.Prefetcher(
+            self.image_cache, PREFETCH_AHEAD, PREFETCH_BEHIND)
+        self.loader = ImageLoader(self.image_cache, self)
+        self.loader.loaded.connect(self.on_image_loaded)
+        self.loader.segmented.connect(self.on_image_segmented)
+        self.loader.failed.connect(self.on_image_failed)
+        self.img = None
+        self.loaded = None
+        self.segments = None
+        self.segments_requested = False
+
+        self.sample = sample.Sample()
+        self.journal = journal.SampleJournal(
+            JOURNAL_FILE, self.sample.get_csv_head(),
+            JOURNAL_FLUSH_ROWS, JOURNAL_FLUSH_MS / 1000)
+        self.journal_timer = QtCore.QTimer(self)
+        self.journal_timer.timeout.connect(self.journal.flush)
+        self.journal_timer.start(JOURNAL_FLUSH_MS)
+        self.database = sample_db.SampleDatabase(DATABASE_FILE)
         self.rgb_mean_demo = [1, 1, 1]
+        self.reset_accumulation()
+
+        # Last values pushed to each side panel widget, see refresh()
+        self.shown = {}
+        self.refresh_pending = False
+        self.canvas_dirty = False
 
         plt_vbox = QtGui.QVBoxLayout()
         self.canvas = FigureCanvasQTAgg(self.figure)
@@ -172,6 +299,7 @@ class MainWindow(QtGui.QMainWindow):
         if DISPLAY_PYPLOT_TOOLBAR:
             self.toolbar = NavigationToolbar2QT(self.canvas, self)
             plt_vbox.addWidget(self.toolbar)
+        plt_vbox.addWidget(self.create_filmstrip())
 
         self.load_plumreg_data()
 
@@ -183,10 +311,40 @@ class MainWindow(QtGui.QMainWindow):
         main_hbox.addLayout(plt_vbox)
         main_hbox.addLayout(side_panel_vbox)
 
-        self.species_dlg = SpeciesDialog(self)
+        # The taxonomy loads in the background; the dialog is built on the
+        # first "Select species" click
+        self.background_tasks = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1)
+        self.ioc_future = self.background_tasks.submit(ioc_parser.IOC)
+        self.ioc_future.add_done_callback(lambda f: log_startup('taxonomy'))
+        self.species_dlg = None
 
         self.main.setLayout(main_hbox)
         self.connect_mouse_events()
+        self.schedule_refresh()
+        QtCore.QTimer.singleShot(0, self.recover_journal)
+
+    def recover_journal(self):
+        if self.journal.stale_file is not None:
+            QtGui.QMessageBox.warning(
+                self, 'Unsaved samples',
+                'Unsaved samples in an older format were moved to {}'.format(
+                    self.journal.stale_file))
+        if self.journal.count == 0:
+            return
+        answer = QtGui.QMessageBox.question(
+            self, 'Unsaved samples',
+            'The last session ended with {} unsaved samples. '
+            'Recover them?'.format(self.journal.count),
+            QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
+        if answer == QtGui.QMessageBox.Yes:
+            self.show_unsaved_count()
+        else:
+            self.journal.clear()
+
+    def show_unsaved_count(self):
+        self.statusBar().showMessage(
+            '{} unsaved samples'.format(self.journal.count))
 
     def load_plumreg_data(self):
         self.plumregs = []
@@ -201,13 +359,13 @@ class MainWindow(QtGui.QMainWindow):
             'motion_notify_event', self.cursor.mouse_move)
         self.figure.canvas.mpl_connect(
             'scroll_event', self.cursor.mouse_scroll)
+        self.figure.canvas.mpl_connect(
+            'draw_event', self.cursor.on_draw)
 
         self.figure.canvas.mpl_connect(
             'button_press_event', self.on_click)
         self.figure.canvas.mpl_connect(
-            'scroll_event', self.on_scroll)
-        self.figure.canvas.mpl_connect(
-            'motion_notify_event', self.on_move)
+            'resize_event', self.on_resize)
 
     def create_menubar(self):
         openFile = QtGui.QAction(QtGui.QIcon('open.png'), 'Open', self)
@@ -215,11 +373,21 @@ class MainWindow(QtGui.QMainWindow):
         openFile.setStatusTip('Open new file')
         openFile.triggered.connect(self.showDialog)
 
+        open_folder = QtGui.QAction('Open folder...', self)
+        open_folder.setShortcut('Ctrl+Shift+O')
+        open_folder.setStatusTip('Open all images in a folder and below')
+        open_folder.triggered.connect(self.open_folder)
+
         save_action = QtGui.QAction(QtGui.QIcon('save.png'), 'Save', self)
         save_action.setShortcut('Ctrl+S')
-        save_action.setStatusTip('Save data to file')
+        save_action.setStatusTip('Save inserted samples to the database')
         save_action.triggered.connect(self.save)
 
+        export_action = QtGui.QAction('Export...', self)
+        export_action.setShortcut('Ctrl+E')
+        export_action.setStatusTip('Export the sample database to a file')
+        export_action.triggered.connect(self.export)
+
         exitAction = QtGui.QAction(QtGui.QIcon('exit.png'), '&Exit', self)
         exitAction.setShortcut('Ctrl+Q')
         exitAction.setStatusTip('Exit application')
@@ -229,10 +397,59 @@ class MainWindow(QtGui.QMainWindow):
 
         fileMenu = menubar.addMenu('&File')
         fileMenu.addAction(openFile)
+        fileMenu.addAction(open_folder)
         fileMenu.addAction(save_action)
+        fileMenu.addAction(export_action)
         fileMenu.addSeparator()
         fileMenu.addAction(exitAction)
 
+    def create_filmstrip(self):
+        # Built on the first thumbnail request
+        self.thumbnails = None
+        self.thumbnail_model = ThumbnailModel(self.thumbnail_builder, self)
+        self.filmstrip = QtGui.QListView(self)
+        self.filmstrip.setViewMode(QtGui.QListView.IconMode)
+        self.filmstrip.setFlow(QtGui.QListView.LeftToRight)
+        self.filmstrip.setWrapping(False)
+        # Equal item sizes let the view lay out 20k items without asking
+        # the model for each of them
+        self.filmstrip.setUniformItemSizes(True)
+        self.filmstrip.setMovement(QtGui.QListView.Static)
+        size = THUMBNAIL_SIZE
+        self.filmstrip.setIconSize(QtCore.QSize(size, size))
+        self.filmstrip.setGridSize(QtCore.QSize(size + 16, size + 24))
+        self.filmstrip.setFixedHeight(size + 48)
+        self.filmstrip.setModel(self.thumbnail_model)
+        self.filmstrip.clicked.connect(self.filmstrip_clicked)
+        self.filmstrip.horizontalScrollBar().valueChanged.connect(
+            self.filmstrip_scrolled)
+        self.folder_scanned.connect(self.on_folder_scanned)
+        self.folder_failed.connect(self.on_folder_failed)
+        return self.filmstrip
+
+    def thumbnail_builder(self):
+        # thumbnails pulls in the image decoders, only needed once a folder
+        # is open
+        if self.thumbnails is None:
+            import thumbnails
+            self.thumbnails = thumbnails.ThumbnailBuilder(
+                self.fingerprints, size=THUMBNAIL_SIZE)
+        return self.thumbnails
+
+    def filmstrip_clicked(self, index):
+        self.file_index = index.row()
+        self.reset_figure()
+
+    def filmstrip_scrolled(self, *args):
+        viewport = self.filmstrip.viewport().rect()
+        first = self.filmstrip.indexAt(viewport.topLeft()).row()
+        last = self.filmstrip.indexAt(viewport.topRight()).row()
+        if first < 0:
+            return
+        if last < 0:
+            last = len(self.files) - 1
+        self.thumbnail_model.cancel_outside(first, last)
+
     def create_side_panel(self):
         layout = QtGui.QVBoxLayout()
 
@@ -289,6 +506,11 @@ class MainWindow(QtGui.QMainWindow):
                 'RB',
                 'R',
             ]),
+            ('method', 'Sampling', [
+                'Square',
+                'Superpixel',
+                'Merged superpixels',
+            ]),
         ]
         self.boxes = {}
 
@@ -303,9 +525,18 @@ class MainWindow(QtGui.QMainWindow):
             i += 1
         # Initialize the combo box sample fields
         self.combo_change()
+        self.boxes['method'].currentIndexChanged.connect(
+            self.reset_accumulation)
         self.box_group.setLayout(grid)
         layout.addWidget(self.box_group)
 
+        self.accumulate_box = QtGui.QCheckBox('Accumulate patches', self)
+        self.accumulate_box.toggled.connect(self.reset_accumulation)
+        layout.addWidget(self.accumulate_box)
+        self.overlap_box = QtGui.QCheckBox('Skip pixels already sampled', self)
+        self.overlap_box.toggled.connect(self.reset_accumulation)
+        layout.addWidget(self.overlap_box)
+
         self.display_area = QtGui.QTextEdit(self)
         self.display_area.setReadOnly(True)
         # self.display_area.setCurrentFont(QtGui.QFont('Courier New', 8))
@@ -340,19 +571,101 @@ class MainWindow(QtGui.QMainWindow):
             self.boxes['imgtype'].currentText().lower())
         plumreg_accr = self.plumregs[self.boxes['plumreg'].currentIndex()][0]
         self.sample.data['plumreg'] = plumreg_accr.lower()
+        self.sample.data['method'] = (
+            self.boxes['method'].currentText().lower())
+        self.cursor.set_enabled(self.sample.data['method'] == 'square')
+        if self.sample.data['method'] != 'square':
+            self.request_segments()
+
+    def request_segments(self):
+        # Superpixels take seconds per image, so they are only computed
+        # once a superpixel method is in use
+        if self.loaded is None or self.segments_requested:
+            return
+        self.segments_requested = True
+        self.loader.request_segments(self.loaded)
+
+    def load_image(self, path, cancelled=lambda: False):
+        return image_cache.load_image(
+            self.planes, self.fingerprints, path, cancelled)
 
     def reset_figure(self):
-        self.sample.data['imgfile'] = os.path.basename(
-            self.files[self.file_index])
+        path = self.files[self.file_index]
+        self.sample.data['imgfile'] = os.path.basename(path)
+        self.sample.data['imghash'] = ''
+        self.img = None
+        self.loaded = None
+        self.segments = None
+        self.segments_requested = False
+        self.reset_accumulation()
         self.figure.clear()
-        self.img = mpimg.imread(self.files[self.file_index])
-        plt.imshow(self.img)
-        self.cursor.reset(self.figure.axes[0])
-        self.figure.axes[0].get_xaxis().set_visible(False)
-        self.figure.axes[0].get_yaxis().set_visible(False)
-        self.repaint()
+        ax = self.figure.add_subplot(111)
+        ax.set_axis_off()
+        ax.text(0.5, 0.5, 'Loading {}...'.format(os.path.basename(path)),
+                ha='center', va='center', transform=ax.transAxes)
+        self.loader.request(path)
+        self.prefetcher.update(self.files, self.file_index)
+        index = self.thumbnail_model.index(self.file_index)
+        self.filmstrip.setCurrentIndex(index)
+        self.filmstrip.scrollTo(index)
+        self.schedule_refresh(redraw=True)
+
+    def on_image_loaded(self, generation, loaded):
+        if generation != self.loader.generation:
+            return
+        self.sample.data['imghash'] = loaded.digest
+        self.loaded = loaded
+        self.img = loaded.img
+        self.hsv = loaded.hsv
+        self.patch_index = loaded.index
+        self.hist_index = loaded.histograms
+        self.pyramid = loaded.pyramid
+        self.figure.clear()
+        # Every pyramid level is placed in full-resolution pixel coordinates,
+        # so event.xdata and event.ydata always index into self.img
+        self.pyramid_level = 0
+        ax = self.figure.add_subplot(111)
+        self.image_artist = ax.imshow(self.img)
+        height, width = self.img.shape[:2]
+        ax.set_xlim(-0.5, width - 0.5)
+        ax.set_ylim(height - 0.5, -0.5)
+        ax.set_autoscale_on(False)
+        ax.callbacks.connect('xlim_changed', self.on_view_changed)
+        ax.callbacks.connect('ylim_changed', self.on_view_changed)
+        self.ax = ax
+        self.on_view_changed(ax)
+        self.cursor.reset(ax)
+        ax.get_xaxis().set_visible(False)
+        ax.get_yaxis().set_visible(False)
+        if self.sample.data['method'] != 'square':
+            self.request_segments()
+        self.schedule_refresh(redraw=True)
+
+    def on_view_changed(self, ax):
+        level = pyramid.choose_level(self.pyramid, ax)
+        if level == self.pyramid_level:
+            return
+        self.pyramid_level = level
+        self.image_artist.set_data(self.pyramid[level])
+        self.image_artist.set_extent(
+            pyramid.level_extent(self.pyramid[level], 2 ** level))
+
+    def on_image_segmented(self, generation, segments):
+        if generation == self.loader.generation:
+            self.segments = segments
+
+    def on_image_failed(self, generation, message):
+        if generation == self.loader.generation:
+            self.statusBar().showMessage('Could not load {}'.format(message))
 
     def show_species_dialog(self):
+        if self.species_dlg is None:
+            QtGui.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+            try:
+                self.species_dlg = SpeciesDialog(
+                    self.ioc_future.result(), self)
+            finally:
+                QtGui.QApplication.restoreOverrideCursor()
         if self.species_dlg.exec_():
             self.sample.data['genus'] = self.species_dlg.genus
             self.sample.data['species'] = self.species_dlg.species
@@ -371,8 +684,65 @@ class MainWindow(QtGui.QMainWindow):
         self.load_dir = os.path.dirname(self.files[0])
         # TODO Do some error checking here
         self.file_index = 0
+        self.thumbnail_model.set_files(self.files)
+        self.reset_figure()
+
+    def open_folder(self):
+        directory = QtGui.QFileDialog.getExistingDirectory(
+            self, 'Open folder', self.load_dir)
+        if not directory:
+            return
+        self.load_dir = directory
+        self.statusBar().showMessage('Scanning {}...'.format(directory))
+        future = self.background_tasks.submit(self.scan_folder, directory)
+        future.add_done_callback(
+            lambda f: self.folder_scan_done(directory, f))
+
+    def scan_folder(self, directory):
+        files = sorted(fingerprint.scan_images(directory))
+        fingerprints = fingerprint.FingerprintIndex(
+            os.path.join(directory, fingerprint.INDEX_FILE))
+        return files, fingerprints
+
+    def folder_scan_done(self, directory, future):
+        # Called on the worker thread; the signals queue to the GUI thread
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is None:
+            self.folder_scanned.emit(directory, future.result())
+        else:
+            self.folder_failed.emit(directory, str(e))
+
+    def on_folder_failed(self, directory, message):
+        self.statusBar().showMessage(
+            'Could not scan {}: {}'.format(directory, message))
+
+    def on_folder_scanned(self, directory, result):
+        files, fingerprints = result
+        self.statusBar().showMessage(
+            'Found {} images in {}'.format(len(files), directory))
+        if not files:
+            return
+        # Hashes of the folder's images are kept in the folder, for the
+        # next session and for resample.py
+        self.save_fingerprints()
+        self.fingerprints = fingerprints
+        if self.thumbnails is not None:
+            self.thumbnails.fingerprints = fingerprints
+        self.files = files
+        self.file_index = 0
+        self.thumbnail_model.set_files(files)
         self.reset_figure()
 
+    def save_fingerprints(self):
+        # The folder may well be read-only, such as on a shared drive
+        try:
+            self.fingerprints.save()
+        except OSError as e:
+            self.statusBar().showMessage(
+                'Could not save image hashes: {}'.format(e))
+
     def next_file(self):
         if self.file_index < len(self.files) - 1:
             self.file_index += 1
@@ -390,89 +760,203 @@ class MainWindow(QtGui.QMainWindow):
             return os.path.basename(self.files[self.file_index])
 
     def insert(self):
-        self.data.append(self.sample.get_csv())
+        self.journal.append(self.sample.get_csv())
+        self.show_unsaved_count()
+        self.reset_accumulation()
+
+    def reset_accumulation(self, *args):
+        """Start a new sample in accumulate mode."""
+        self.accumulated = patch_stats.RunningStats(3 * len(COLOUR_SPACES))
+        self.accumulated_rgb = np.zeros(3)
+        self.accumulated_hist = np.zeros(
+            (3, histograms.INDEX_BINS), dtype=np.int64)
+        self.sample.data['patches'] = 1
+        # Pixels and superpixels already in the sample, when skipping them
+        self.coverage = None
+        self.counted_segments = set()
+
+    def skipping_overlap(self):
+        return (self.accumulate_box.isChecked() and
+                self.overlap_box.isChecked())
 
     def save(self):
+        inserted, duplicates = self.database.insert_csv(self.journal.lines())
+        self.journal.clear()
+        message = 'Saved {} samples to {}'.format(inserted, DATABASE_FILE)
+        if duplicates:
+            message += ', skipped {} duplicates'.format(duplicates)
+        self.statusBar().showMessage(message)
+
+    def export(self):
         now = datetime.datetime.now().strftime('%y%m%d%H%M')
         suggested_name = 'digbird_{}.csv'.format(now)
         suggested_file = os.path.join(self.save_dir, suggested_name)
         file_name = QtGui.QFileDialog.getSaveFileName(
-            self, 'Save to file', suggested_file)
+            self, 'Export to file', suggested_file,
+            'CSV (*.csv);;NumPy archive (*.npz);;Parquet (*.parquet)')
+        if not file_name:
+            return
         self.save_dir = os.path.dirname(file_name)
 
-        with open(file_name, 'w') as f:
-            f.write('{}\n'.format(self.sample.get_csv_head()))
-            for d in self.data:
-                f.write('{}\n'.format(d))
-        self.data = []
-
-    def on_move(self, event):
-        self.repaint()
+        count = self.database.export(file_name)
+        self.statusBar().showMessage(
+            'Exported {} samples to {}'.format(count, file_name))
+
+    def closeEvent(self, event):
+        self.loader.shutdown()
+        self.prefetcher.shutdown()
+        self.background_tasks.shutdown(wait=False)
+        if self.thumbnails is not None:
+            self.thumbnails.shutdown()
+        # Unsaved samples first, whatever happens to the rest
+        self.journal.close()
+        self.database.close()
+        self.save_fingerprints()
+        super().closeEvent(event)
 
     def on_click(self, event):
+        if self.img is None or not event.inaxes:
+            return
         x, y = int(event.xdata), int(event.ydata)
-        radius = self.cursor.radius
-        if radius <= 0:
-            selected = self.img[y:y+1, x:x+1]
+        if self.sample.data['method'] == 'square':
+            result = self.sample_square(x, y)
         else:
-            x1, x2 = x - radius + 2, x + radius + 2
-            y1, y2 = y - radius + 2, y + radius + 2
-            selected = self.img[y1:y2, x1:x2]
-
-        a, b, c = selected.shape
-        rgb = selected.reshape((a * b, c))
-        self.rgb_mean_demo = list(np.mean(rgb, axis=0))[:3]
-
-        selected_hsv = skimage.color.rgb2hsv(selected[:, :, :3])
-        a, b, c = selected_hsv.shape
-        hsv = selected_hsv.reshape((a * b, c))
-
-        hsv_mean = np.around(list(np.mean(hsv, axis=0))[:3], decimals=2)
-        hsv_std = np.around(list(np.std(hsv, axis=0))[:3], decimals=2)
-        hsv_min = np.around([np.amin(hsv[:, i]) for i in range(3)], decimals=2)
-        hsv_max = np.around([np.amax(hsv[:, i]) for i in range(3)], decimals=2)
-
-        self.sample.data['h_mean'] = hsv_mean[0]
-        self.sample.data['s_mean'] = hsv_mean[1]
-        self.sample.data['v_mean'] = hsv_mean[2]
-
-        self.sample.data['h_std'] = hsv_std[0]
-        self.sample.data['s_std'] = hsv_std[1]
-        self.sample.data['v_std'] = hsv_std[2]
-
-        self.sample.data['h_min'] = hsv_min[0]
-        self.sample.data['s_min'] = hsv_min[1]
-        self.sample.data['v_min'] = hsv_min[2]
-
-        self.sample.data['h_max'] = hsv_max[0]
-        self.sample.data['s_max'] = hsv_max[1]
-        self.sample.data['v_max'] = hsv_max[2]
-
-        self.sample.data['size'] = (self.cursor.radius * 2) ** 2
+            result = self.sample_superpixels(x, y)
+        if result is None:
+            return
+        stats, rgb_mean, hist = result
+
+        if self.accumulate_box.isChecked():
+            stats, rgb_mean, hist = self.accumulate(stats, rgb_mean, hist)
+        # The size of a square sample is the area of the (last) square,
+        # also where it is clipped, as resample.py rebuilds the radius
+        # from it
+        if self.sample.data['method'] == 'square':
+            size = (self.cursor.radius * 2) ** 2
+        else:
+            size = stats.count
+        self.rgb_mean_demo = list(rgb_mean)
+        self.sample.set_stats(stats, COLOUR_SPACES)
+        self.sample.set_histogram(hist)
+        self.sample.data['size'] = int(size)
+        self.sample.data['pixels'] = int(stats.count)
         self.sample.data['x'] = x
         self.sample.data['y'] = y
+        self.schedule_refresh()
+
+    def accumulate(self, stats, rgb_mean, hist):
+        """Add a patch to the current sample, returning the combined stats."""
+        if self.accumulated.count > 0:
+            self.sample.data['patches'] += 1
+        self.accumulated.add(stats)
+        self.accumulated_rgb += rgb_mean * stats.count
+        self.accumulated_hist += hist
+        return (self.accumulated.stats(),
+                self.accumulated_rgb / self.accumulated.count,
+                self.accumulated_hist)
+
+    def sample_square(self, x, y):
+        radius = self.cursor.radius
+        bounds = patch_stats.patch_bounds(x, y, radius, self.img.shape)
+        y1, y2, x1, x2 = bounds
+        selected = self.img[y1:y2, x1:x2]
+        if selected.size == 0:
+            return None
+        hsv = plane_cache.dequantize(self.hsv[y1:y2, x1:x2])
+
+        if self.skipping_overlap():
+            if self.coverage is None:
+                self.coverage = patch_stats.Coverage(self.img.shape)
+            new = self.coverage.take(bounds)
+            if not new.any():
+                self.statusBar().showMessage('All pixels already sampled')
+                return None
+            selected, hsv = selected[new], hsv[new]
+            extra = patch_stats.to_colour_spaces(
+                selected, EXTRA_COLOUR_SPACES)
+            stats = patch_stats.reduce_pixels(
+                np.concatenate([hsv, extra], axis=-1))
+            hist = histograms.pixel_histogram(
+                histograms.to_bins(self.hsv[y1:y2, x1:x2][new]))
+        else:
+            selected, hsv = selected.reshape(-1, 3), hsv.reshape(-1, 3)
+            extra = patch_stats.reduce_pixels(patch_stats.to_colour_spaces(
+                selected, EXTRA_COLOUR_SPACES))
+            if self.patch_index is None:
+                hsv_stats = patch_stats.reduce_pixels(hsv)
+            else:
+                # HSV mean and std come from the summed-area tables, so
+                # only the extremes need a pass over the patch pixels
+                count, mean, std = self.patch_index.query(x, y, radius)
+                hsv_stats = patch_stats.PatchStats(
+                    count[0], mean[0], std[0],
+                    hsv.min(axis=0), hsv.max(axis=0))
+            stats = patch_stats.concat_stats(hsv_stats, extra)
+            hist = self.hist_index.query(bounds)
+        rgb = patch_stats.to_float_rgb(selected)
+        return stats, rgb.mean(axis=0), hist
+
+    def sample_superpixels(self, x, y):
+        if self.segments is None:
+            self.request_segments()
+            self.statusBar().showMessage(
+                'Superpixels are still being computed')
+            return None
+        threshold = None
+        if self.sample.data['method'] == 'merged superpixels':
+            threshold = THRESHOLD
+        selected = superpixels.select(self.segments, x, y, threshold)
+        if self.skipping_overlap():
+            counted = list(self.counted_segments)
+            selected = selected[~np.isin(selected, counted)]
+            if len(selected) == 0:
+                self.statusBar().showMessage('All pixels already sampled')
+                return None
+            self.counted_segments.update(selected.tolist())
+        return superpixels.selection_stats(self.segments, selected)
+
+    def on_resize(self, event):
+        if self.img is not None:
+            self.on_view_changed(self.ax)
+
+    def schedule_refresh(self, redraw=False):
+        self.canvas_dirty = self.canvas_dirty or redraw
+        if not self.refresh_pending:
+            self.refresh_pending = True
+            QtCore.QTimer.singleShot(REFRESH_INTERVAL_MS, self.refresh)
+
+    def refresh(self):
+        self.refresh_pending = False
+        if self.canvas_dirty:
+            self.canvas_dirty = False
+            self.canvas.draw_idle()
+
         self.update_text()
-        self.repaint()
+        self.render_area.set_color(self.rgb_mean_demo)
+        if self.changed('file_label', self.get_file_name()):
+            self.file_label.setText(self.shown['file_label'])
+        filenum = '{}/{}'.format(
+            self.file_index + 1 if len(self.files) > 0 else 0,
+            len(self.files),
+        )
+        if self.changed('filenum_label', filenum):
+            self.filenum_label.setText(filenum)
 
-    def on_scroll(self, event):
-        self.repaint()
+    def changed(self, widget, value):
+        """Record value as shown by widget, returning whether it differs."""
+        if self.shown.get(widget) == value:
+            return False
+        self.shown[widget] = value
+        return True
 
     def update_text(self):
-        result = ""
         display_items = self.sample.get_display()
+        if not self.changed('display_area', display_items):
+            return
         total_w = 33
-        for (k, v) in display_items:
-            s = '{}:{:>{}}\n'.format(str(k), str(v), total_w - len(str(k)))
-            result += s
-        self.display_area.setText(result)
-
-    def paintEvent(self, event):
-        self.canvas.draw()
-        self.update_text()
-        self.file_label.setText(self.get_file_name())
-        self.filenum_label.setText('{}/{}'.format(
-            self.file_index + 1 if len(self.files) > 0 else 0,
-            len(self.files),
+        self.display_area.setText(''.join(
+            '{}:{:>{}}\n'.format(str(k), str(v), total_w - len(str(k)))
+            for (k, v) in display_items
         ))
 
 
@@ -481,19 +965,143 @@ class RenderArea(QtGui.QWidget):
         super().__init__(parent)
         self.parent = parent
         self.setFixedSize(300, 50)
+        self.color = None
+        self.set_color(parent.rgb_mean_demo)
+
+    def set_color(self, rgb):
+        def f(x): return int(x * 255)
+        color = QtGui.QColor(*list(map(f, rgb)))
+        if color != self.color:
+            self.color = color
+            self.update()
 
     def paintEvent(self, event):
         qp = QtGui.QPainter()
         qp.begin(self)
-
-        def f(x): return int(x * 255)
-        col_rgb = QtGui.QColor(*list(map(f, self.parent.rgb_mean_demo)))
-        qp.fillRect(0, 0, self.width(), self.height(), col_rgb)
+        qp.fillRect(0, 0, self.width(), self.height(), self.color)
         qp.end()
 
 
+class TableModel(QtCore.QAbstractTableModel):
+    """Read-only model serving cells from a list of row tuples on demand.
+
+    Replacing the rows is a single model reset rather than one insert per
+    row and one item per cell.
+    """
+
+    def __init__(self, headings, parent=None):
+        super().__init__(parent)
+        self.headings = headings
+        self.rows = []
+
+    def set_rows(self, rows):
+        self.beginResetModel()
+        self.rows = rows
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.headings)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if index.isValid() and role == QtCore.Qt.DisplayRole:
+            return self.rows[index.row()][index.column()]
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if (role == QtCore.Qt.DisplayRole and
+                orientation == QtCore.Qt.Horizontal):
+            return self.headings[section]
+        return None
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        self.layoutAboutToBeChanged.emit()
+        self.rows = sorted(
+            self.rows, key=lambda row: row[column] or '',
+            reverse=order == QtCore.Qt.DescendingOrder)
+        self.layoutChanged.emit()
+
+
+class ThumbnailModel(QtCore.QAbstractListModel):
+    """Filmstrip of the open files, building thumbnails on demand.
+
+    Thumbnails are only requested when the view first asks for an item,
+    that is when it scrolls into view, and are kept for the most recently
+    shown THUMBNAIL_MEMORY items.
+    """
+    ready = QtCore.pyqtSignal(str, str)
+
+    def __init__(self, get_builder, parent=None):
+        super().__init__(parent)
+        self.get_builder = get_builder
+        self.files = []
+        self.rows = {}
+        self.pixmaps = collections.OrderedDict()
+        self.requested = {}
+        self.ready.connect(self.on_ready)
+
+    def set_files(self, files):
+        self.beginResetModel()
+        for future in self.requested.values():
+            future.cancel()
+        self.files = files
+        self.rows = {path: row for row, path in enumerate(files)}
+        self.pixmaps.clear()
+        self.requested.clear()
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.files)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        path = self.files[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return os.path.basename(path)
+        if role == QtCore.Qt.ToolTipRole:
+            return path
+        if role == QtCore.Qt.DecorationRole:
+            if path in self.pixmaps:
+                self.pixmaps.move_to_end(path)
+                return self.pixmaps[path]
+            self.request(path)
+        return None
+
+    def request(self, path):
+        if path in self.requested:
+            return
+        future = self.get_builder().request(path)
+        self.requested[path] = future
+        future.add_done_callback(lambda f: self.emit_ready(path, f))
+
+    def emit_ready(self, path, future):
+        # Called on a worker thread; the pixmap is made on the GUI thread
+        if not future.cancelled() and future.exception() is None:
+            self.ready.emit(path, future.result()[1])
+
+    def on_ready(self, path, file_name):
+        self.requested.pop(path, None)
+        row = self.rows.get(path)
+        if row is None:
+            return
+        self.pixmaps[path] = QtGui.QPixmap(file_name)
+        while len(self.pixmaps) > THUMBNAIL_MEMORY:
+            self.pixmaps.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+    def cancel_outside(self, first, last):
+        """Drop queued requests for items scrolled out of rows first-last."""
+        for path, future in list(self.requested.items()):
+            if not first <= self.rows[path] <= last and future.cancel():
+                del self.requested[path]
+
+
 class SpeciesDialog(QtGui.QDialog):
-    def __init__(self, parent=None):
+    def __init__(self, ioc, parent=None):
         super().__init__(parent)
         self.headings = [
             'Latin name',
@@ -506,7 +1114,16 @@ class SpeciesDialog(QtGui.QDialog):
         self.species = None
         self.subspecies = None
 
-        self.ioc = ioc_parser.IOC()
+        self.ioc = ioc
+        # Filtering selects from the full list by row number, using one
+        # search index per column
+        self.all_species = self.ioc.get_species()
+        self.species_ids = {row: i for i, row in enumerate(self.all_species)}
+        self.name_indexes = [
+            name_index.NameIndex([row[i] for row in self.all_species])
+            for i in range(len(self.headings))
+        ]
+        self.visible = []
 
         self.proxy_model = QtGui.QSortFilterProxyModel()
         self.proxy_model.setDynamicSortFilter(True)
@@ -536,9 +1153,7 @@ class SpeciesDialog(QtGui.QDialog):
         self.family = self.family_box.currentText()
         main_layout.addLayout(grid)
 
-        self.create_model()
-        self.insert_data()
-
+        self.model = TableModel(self.headings, self)
         self.proxy_model.setSourceModel(self.model)
 
         main_layout.addWidget(QtGui.QLabel('Species'))
@@ -554,9 +1169,17 @@ class SpeciesDialog(QtGui.QDialog):
         for h in self.headings:
             self.filter_column_box.addItem(h)
         self.filter_column_box.currentIndexChanged.connect(
-            self.proxy_model.setFilterKeyColumn)
+            self.filter_changed)
         filter_hbox.addWidget(self.filter_column_box)
 
+        self.fuzzy_box = QtGui.QCheckBox('Fuzzy', self)
+        self.fuzzy_box.setToolTip(
+            'Match misspelled names when nothing matches exactly')
+        self.fuzzy_box.stateChanged.connect(self.filter_changed)
+        filter_hbox.addWidget(self.fuzzy_box)
+
+        self.insert_data()
+
         self.list_view = QtGui.QTableView()
         self.list_view.setAlternatingRowColors(True)
         self.list_view.setSortingEnabled(True)
@@ -567,7 +1190,7 @@ class SpeciesDialog(QtGui.QDialog):
         self.list_view.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
         main_layout.addWidget(self.list_view)
 
-        self.create_ssp_model()
+        self.ssp_model = TableModel(['Name'], self)
         self.insert_ssp_data()
 
         self.list_view.horizontalHeader().setResizeMode(
@@ -606,24 +1229,18 @@ class SpeciesDialog(QtGui.QDialog):
         for family in self.ioc.get_families(order=self.order):
             self.family_box.addItem(family)
 
-        self.create_model()
         self.insert_data()
-        self.proxy_model.setSourceModel(self.model)
 
     def family_changed(self, event):
         self.family = self.family_box.currentText()
-        self.create_model()
         self.insert_data()
-        self.proxy_model.setSourceModel(self.model)
 
     def select_species(self, event):
         indexes = self.list_view.selectedIndexes()
         if indexes:
             self.genus, self.species = indexes[0].data().split()
             self.subspecies = None
-            self.create_ssp_model()
             self.insert_ssp_data()
-            self.ssp_list.setModel(self.ssp_model)
 
     def select_subspecies(self, event):
         indexes = self.ssp_list.selectedIndexes()
@@ -633,42 +1250,40 @@ class SpeciesDialog(QtGui.QDialog):
     def select(self, event):
         self.accept()
 
-    def filter_changed(self):
+    def filter_changed(self, *args):
         pattern = self.filter_pattern_edit.text()
-        regex = QtCore.QRegExp(pattern, QtCore.Qt.CaseInsensitive, 0)
-        self.proxy_model.setFilterRegExp(regex)
-
-    def create_model(self):
-        self.model = QtGui.QStandardItemModel(0, len(self.headings), self)
-        for i in range(len(self.headings)):
-            self.model.setHeaderData(i, QtCore.Qt.Horizontal, self.headings[i])
-
-    def create_ssp_model(self):
-        self.ssp_model = QtGui.QStandardItemModel(0, 1, self)
-        self.ssp_model.setHeaderData(0, QtCore.Qt.Horizontal, 'Name')
+        rows = self.visible
+        if pattern:
+            index = self.name_indexes[self.filter_column_box.currentIndex()]
+            matches = index.search(pattern)
+            if not matches and self.fuzzy_box.isChecked():
+                matches = index.fuzzy_search(pattern)
+            rows = [i for i in rows if i in matches]
+        self.model.set_rows([self.all_species[i] for i in rows])
 
     def insert_ssp_data(self):
         if self.species is None:
+            self.ssp_model.set_rows([])
             return
         ssps = self.ioc.get_subspecies(self.genus, self.species)
-        for ssp in ssps:
-            self.ssp_model.insertRow(0)
-            self.ssp_model.setData(self.ssp_model.index(0, 0), ssp)
+        self.ssp_model.set_rows([(ssp,) for ssp in ssps])
 
     def insert_data(self):
-        species = self.ioc.get_species(order=self.order, family=self.family)
-        for row in species:
-            self.model.insertRow(0)
-            for i, c in enumerate(row):
-                self.model.setData(self.model.index(0, i), c)
+        rows = self.ioc.get_species(order=self.order, family=self.family)
+        self.visible = [self.species_ids[row] for row in rows]
+        self.filter_changed()
 
 
 def main():
     app = QtGui.QApplication(sys.argv)
     win = MainWindow()
+    log_startup('window')
     win.show()
+    QtCore.QTimer.singleShot(0, lambda: log_startup('shown'))
     sys.exit(app.exec_())
 
 
 if __name__ == '__main__':
+    # Thumbnails are built in worker processes, also in frozen builds
+    multiprocessing.freeze_support()
     main()
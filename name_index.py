@@ -0,0 +1,54 @@
+import collections
+import difflib
+
+NGRAM = 3
+
+
+def ngrams(text):
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class NameIndex(object):
+    """Case-insensitive substring search over a fixed list of names.
+
+    Queries of at least NGRAM characters are answered from a trigram
+    index. A query that extends the previous one only rechecks the rows
+    matched last time, so results narrow incrementally while typing.
+    """
+
+    def __init__(self, names):
+        self.names = [(n or '').lower() for n in names]
+        self.postings = collections.defaultdict(set)
+        self.words = collections.defaultdict(set)
+        for i, name in enumerate(self.names):
+            for gram in ngrams(name):
+                self.postings[gram].add(i)
+            for word in name.split():
+                self.words[word].add(i)
+        self.last_query = None
+        self.last_result = None
+
+    def search(self, query):
+        """Return the set of row numbers whose name contains query."""
+        query = query.lower()
+        if self.last_query is not None and self.last_query in query:
+            candidates = self.last_result
+        elif len(query) >= NGRAM:
+            grams = sorted(
+                (self.postings.get(g, set()) for g in ngrams(query)), key=len)
+            candidates = grams[0].intersection(*grams[1:])
+        else:
+            candidates = range(len(self.names))
+        result = {i for i in candidates if query in self.names[i]}
+        self.last_query, self.last_result = query, result
+        return result
+
+    def fuzzy_search(self, query, cutoff=0.75):
+        """Rows with a word close to each word of query, for misspellings."""
+        result = None
+        for word in query.lower().split():
+            close = difflib.get_close_matches(
+                word, self.words.keys(), n=10, cutoff=cutoff)
+            rows = set().union(*[self.words[w] for w in close])
+            result = rows if result is None else result & rows
+        return result or set()
@@ -0,0 +1,281 @@
+import collections
+
+import numpy as np
+
+# The sampled square is shifted from the cursor position by this many pixels
+PATCH_OFFSET = 2
+# Upper bound on the number of pixels gathered at once by sample_patches
+CHUNK_PIXELS = 2 ** 22
+
+PatchStats = collections.namedtuple(
+    'PatchStats', ['count', 'mean', 'std', 'min', 'max'])
+
+# Column prefixes of the channels of each colour space, in Sample order
+COLOUR_SPACES = collections.OrderedDict([
+    ('hsv', ('h', 's', 'v')),
+    ('lab', ('lab_l', 'lab_a', 'lab_b')),
+    ('linrgb', ('lin_r', 'lin_g', 'lin_b')),
+])
+# Linear sRGB to CIE XYZ, scaled by the D65 white point so that white
+# maps to (1, 1, 1)
+XYZ_FROM_LINEAR = np.array([
+    [0.412453, 0.357580, 0.180423],
+    [0.212671, 0.715160, 0.072169],
+    [0.019334, 0.119193, 0.950227],
+]) / np.array([[0.95047], [1.0], [1.08883]])
+
+
+def to_float_rgb(img):
+    """Return the RGB channels of img as floats in the range [0, 1]."""
+    rgb = img[..., :3]
+    if np.issubdtype(rgb.dtype, np.integer):
+        return rgb / float(np.iinfo(rgb.dtype).max)
+    return rgb.astype(np.float64, copy=False)
+
+
+def rgb_to_hsv(img):
+    # skimage is slow to import, so it is only loaded with the first image
+    import skimage.color
+    return skimage.color.rgb2hsv(to_float_rgb(img))
+
+
+def srgb_to_linear(rgb, out=None):
+    """Undo the sRGB transfer curve of float RGB in [0, 1]."""
+    out = np.divide(rgb, 12.92, out=out)
+    curved = rgb > 0.04045
+    out[curved] = ((rgb[curved] + 0.055) / 1.055) ** 2.4
+    return out
+
+
+def linear_to_lab(linear, out=None):
+    """CIELAB under the D65 white point of linear RGB."""
+    xyz = np.matmul(linear, XYZ_FROM_LINEAR.T)
+    small = xyz <= (6 / 29) ** 3
+    xyz[small] = xyz[small] / (3 * (6 / 29) ** 2) + 4 / 29
+    np.cbrt(xyz, out=xyz, where=~small)
+    if out is None:
+        out = np.empty_like(xyz)
+    out[..., 0] = 116 * xyz[..., 1] - 16
+    out[..., 1] = 500 * (xyz[..., 0] - xyz[..., 1])
+    out[..., 2] = 200 * (xyz[..., 1] - xyz[..., 2])
+    return out
+
+
+def to_colour_spaces(img, spaces, dtype=np.float64):
+    """Channels of img in each of spaces, stacked on the last axis.
+
+    The planes are written into one preallocated array, and linear RGB is
+    computed once for all the spaces derived from it.
+    """
+    rgb = to_float_rgb(img)
+    out = np.empty(rgb.shape[:-1] + (3 * len(spaces),), dtype=dtype)
+    linear = None
+    for i, space in enumerate(spaces):
+        target = out[..., 3 * i:3 * i + 3]
+        if space == 'hsv':
+            target[...] = rgb_to_hsv(rgb)
+            continue
+        if linear is None:
+            linear = srgb_to_linear(rgb)
+        if space == 'linrgb':
+            target[...] = linear
+        elif space == 'lab':
+            linear_to_lab(linear, out=target)
+        else:
+            raise ValueError('unknown colour space {!r}'.format(space))
+    return out
+
+
+def patch_bounds(x, y, radius, shape):
+    """Return the (y1, y2, x1, x2) slice bounds sampled around (x, y)."""
+    return tuple(int(b) for b in patch_bounds_array(x, y, radius, shape)[0])
+
+
+def patch_bounds_array(xs, ys, radii, shape):
+    """Vectorized patch_bounds, returning an (n, 4) array of bounds."""
+    xs, ys, radii = np.broadcast_arrays(
+        *[np.asarray(a, dtype=np.intp).ravel() for a in (xs, ys, radii)])
+    single = radii <= 0
+    start = np.where(single, 0, PATCH_OFFSET - radii)
+    stop = np.where(single, 1, PATCH_OFFSET + radii)
+    height, width = shape[:2]
+    return np.stack([
+        np.clip(ys + start, 0, height), np.clip(ys + stop, 0, height),
+        np.clip(xs + start, 0, width), np.clip(xs + stop, 0, width),
+    ], axis=1)
+
+
+def reduce_pixels(pixels):
+    """Per-channel statistics of an (n, channels) array of pixels."""
+    return PatchStats(
+        count=len(pixels),
+        mean=pixels.mean(axis=0),
+        std=pixels.std(axis=0),
+        min=pixels.min(axis=0),
+        max=pixels.max(axis=0),
+    )
+
+
+def concat_stats(*parts):
+    """Join the channels of PatchStats of the same pixels."""
+    return PatchStats(parts[0].count, *[
+        np.concatenate([getattr(p, name) for p in parts], axis=-1)
+        for name in ('mean', 'std', 'min', 'max')])
+
+
+def sample_patches(planes, xs, ys, radii):
+    """Statistics of many square patches of an (h, w, channels) array.
+
+    Each field of the returned PatchStats holds one row per requested
+    patch. Patches of the same size that lie fully inside the image are
+    gathered together and reduced in a single NumPy call; patches clipped
+    by the image border are reduced one at a time.
+    """
+    bounds = patch_bounds_array(xs, ys, radii, planes.shape)
+    radii = np.broadcast_to(
+        np.asarray(radii, dtype=np.intp).ravel(), len(bounds))
+    n, channels = len(bounds), planes.shape[2]
+
+    count = np.zeros(n, dtype=np.intp)
+    mean = np.full((n, channels), np.nan)
+    std = np.full((n, channels), np.nan)
+    min_ = np.full((n, channels), np.nan)
+    max_ = np.full((n, channels), np.nan)
+
+    heights = bounds[:, 1] - bounds[:, 0]
+    widths = bounds[:, 3] - bounds[:, 2]
+    sides = np.where(radii <= 0, 1, 2 * radii)
+    whole = (heights == sides) & (widths == sides)
+
+    for side in np.unique(sides[whole]):
+        index = np.flatnonzero(whole & (sides == side))
+        windows = np.lib.stride_tricks.sliding_window_view(
+            planes, (side, side), axis=(0, 1))
+        step = max(1, CHUNK_PIXELS // (side * side * channels))
+        for start in range(0, len(index), step):
+            chunk = index[start:start + step]
+            # (patches, channels, side, side) -> (patches, channels, pixels)
+            pixels = windows[bounds[chunk, 0], bounds[chunk, 2]].reshape(
+                len(chunk), channels, side * side)
+            count[chunk] = side * side
+            mean[chunk] = pixels.mean(axis=2)
+            std[chunk] = pixels.std(axis=2)
+            min_[chunk] = pixels.min(axis=2)
+            max_[chunk] = pixels.max(axis=2)
+
+    for i in np.flatnonzero(~whole):
+        y1, y2, x1, x2 = bounds[i]
+        if y1 == y2 or x1 == x2:
+            continue
+        stats = reduce_pixels(planes[y1:y2, x1:x2].reshape(-1, channels))
+        count[i] = stats.count
+        mean[i], std[i] = stats.mean, stats.std
+        min_[i], max_[i] = stats.min, stats.max
+
+    return PatchStats(count, mean, std, min_, max_)
+
+
+def stats_row(stats, i):
+    """PatchStats of the i-th patch of a sample_patches result."""
+    return PatchStats(*[field[i] for field in stats])
+
+
+class PatchIndex(object):
+    """Summed-area tables of an (h, w, channels) integer array and its
+    squares.
+
+    Built once per image, it answers the mean and standard deviation of any
+    patch in constant time regardless of the patch radius. The tables are
+    exact int64 sums of the unsigned 16-bit planes, built a block of rows at
+    a time without float copies of the image; values are divided by scale
+    on the way out.
+    """
+
+    def __init__(self, planes, scale=1):
+        self.shape = planes.shape
+        self.scale = float(scale)
+        self.sums = self._integrate(planes, square=False)
+        self.squares = self._integrate(planes, square=True)
+
+    @staticmethod
+    def _integrate(planes, square):
+        height, width, channels = planes.shape
+        table = np.zeros((height + 1, width + 1, channels), dtype=np.int64)
+        rows = max(1, CHUNK_PIXELS // max(width * channels, 1))
+        for start in range(0, height, rows):
+            block = planes[start:start + rows].astype(np.int64)
+            if square:
+                np.square(block, out=block)
+            np.cumsum(block, axis=1, out=table[1 + start:1 + start + rows, 1:])
+        np.cumsum(table, axis=0, out=table)
+        return table
+
+    def _box(self, table, bounds):
+        y1, y2, x1, x2 = bounds.T
+        return table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+
+    def query(self, xs, ys, radii):
+        """Return (count, mean, std) arrays for the requested patches."""
+        bounds = patch_bounds_array(xs, ys, radii, self.shape)
+        count = (bounds[:, 1] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 2])
+        n = np.maximum(count, 1)[:, np.newaxis]
+        mean = self._box(self.sums, bounds) / n
+        var = np.maximum(self._box(self.squares, bounds) / n - mean ** 2, 0)
+        mean /= self.scale
+        std = np.sqrt(var) / self.scale
+        mean[count == 0] = np.nan
+        std[count == 0] = np.nan
+        return count, mean, std
+
+
+class RunningStats(object):
+    """Statistics of pixels added a patch at a time, never keeping them.
+
+    Patches are merged with the pairwise form of Welford's update, which
+    only needs the count, mean, standard deviation and extremes of each.
+    """
+
+    def __init__(self, channels=3):
+        self.count = 0
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros(channels)
+        self.min = np.full(channels, np.inf)
+        self.max = np.full(channels, -np.inf)
+
+    def add(self, stats):
+        if stats.count == 0:
+            return
+        total = self.count + stats.count
+        delta = stats.mean - self.mean
+        self.mean = self.mean + delta * (stats.count / total)
+        self.m2 = (self.m2 + np.square(stats.std) * stats.count +
+                   np.square(delta) * (self.count * stats.count / total))
+        self.min = np.minimum(self.min, stats.min)
+        self.max = np.maximum(self.max, stats.max)
+        self.count = total
+
+    def stats(self):
+        return PatchStats(
+            self.count, self.mean, np.sqrt(self.m2 / max(self.count, 1)),
+            self.min, self.max)
+
+
+class Coverage(object):
+    """One bit per image pixel marking the pixels already sampled."""
+
+    def __init__(self, shape):
+        height, width = shape[:2]
+        self.bits = np.zeros((height, -(-width // 8)), dtype=np.uint8)
+
+    def take(self, bounds):
+        """Mark the pixels in bounds, returning a mask of the new ones."""
+        y1, y2, x1, x2 = bounds
+        # Whole bytes are unpacked and packed back, so that only the
+        # bytes overlapping the box are touched
+        b1, b2 = x1 // 8, -(-x2 // 8)
+        unpacked = np.unpackbits(self.bits[y1:y2, b1:b2], axis=1)
+        box = unpacked[:, x1 - b1 * 8:x2 - b1 * 8]
+        new = box == 0
+        box[...] = 1
+        self.bits[y1:y2, b1:b2] = np.packbits(unpacked, axis=1)
+        return new
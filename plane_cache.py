@@ -0,0 +1,114 @@
+import collections
+import os
+import shutil
+
+import matplotlib.image as mpimg
+import numpy as np
+
+import patch_stats
+
+CACHE_DIR = os.path.expanduser('~/.digbird/planes')
+# Least recently used images are removed beyond this total size, 4 GiB
+# unless DIGBIRD_PLANE_CACHE_GB says otherwise; a 20 MP image takes 180 MB
+CACHE_BYTES = int(
+    float(os.environ.get('DIGBIRD_PLANE_CACHE_GB', 4)) * 1024 ** 3)
+# HSV values in [0, 1] are stored as multiples of 1 / HSV_SCALE
+HSV_SCALE = 65535
+
+
+class Planes(collections.namedtuple('Planes', ['rgb', 'hsv'])):
+    """uint8 RGB and quantized uint16 HSV planes of one image."""
+
+    @property
+    def nbytes(self):
+        return self.rgb.nbytes + self.hsv.nbytes
+
+
+def to_uint8_rgb(img):
+    rgb = img[..., :3]
+    if rgb.dtype == np.uint8:
+        return rgb
+    return np.round(patch_stats.to_float_rgb(rgb) * 255).astype(np.uint8)
+
+
+def quantize(hsv):
+    return np.round(hsv * HSV_SCALE).astype(np.uint16)
+
+
+def dequantize(hsv):
+    return hsv / float(HSV_SCALE)
+
+
+class PlaneCache(object):
+    """On-disk cache of the RGB and HSV planes of images, by content hash.
+
+    The planes are stored as .npy files and opened memory-mapped, so
+    reopening an image skips both decoding and colour conversion, and
+    only the pixels actually touched are read from disk. When the cache
+    cannot be written, as on a full or read-only disk, the planes are
+    returned in memory instead.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_BYTES,
+                 decode=mpimg.imread):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.decode = decode
+
+    def load(self, path, digest):
+        entry = os.path.join(self.directory, digest)
+        try:
+            planes = self._open(entry)
+        except (OSError, ValueError):
+            planes = self._build(path)
+            try:
+                self._write(entry, planes)
+                planes = self._open(entry)
+                self.prune()
+            except OSError:
+                pass
+        else:
+            # The entry's mtime marks its last use for prune()
+            try:
+                os.utime(entry)
+            except OSError:
+                pass
+        return planes
+
+    def _open(self, entry):
+        return Planes(
+            np.load(os.path.join(entry, 'rgb.npy'), mmap_mode='r'),
+            np.load(os.path.join(entry, 'hsv.npy'), mmap_mode='r'),
+        )
+
+    def _build(self, path):
+        rgb = to_uint8_rgb(self.decode(path))
+        return Planes(rgb, quantize(patch_stats.rgb_to_hsv(rgb)))
+
+    def _write(self, entry, planes):
+        # Written under a temporary name so that a half-written entry is
+        # never opened
+        tmp_entry = '{}.{}.tmp'.format(entry, os.getpid())
+        try:
+            os.makedirs(tmp_entry, exist_ok=True)
+            np.save(os.path.join(tmp_entry, 'rgb.npy'), planes.rgb)
+            np.save(os.path.join(tmp_entry, 'hsv.npy'), planes.hsv)
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.replace(tmp_entry, entry)
+        except OSError:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+
+    def prune(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and not entry.name.endswith('.tmp'):
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
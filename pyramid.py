@@ -0,0 +1,49 @@
+import math
+
+import numpy as np
+
+# Downsampling stops once the longest side of a level is this small
+MIN_LEVEL_SIZE = 512
+
+
+def downsample(img):
+    """Halve both image dimensions by averaging 2x2 blocks."""
+    height, width = img.shape[:2]
+    if height % 2 or width % 2:
+        pad = [(0, height % 2), (0, width % 2)] + [(0, 0)] * (img.ndim - 2)
+        img = np.pad(img, pad, mode='edge')
+    acc = img[0::2, 0::2].astype(np.float32)
+    acc += img[1::2, 0::2]
+    acc += img[0::2, 1::2]
+    acc += img[1::2, 1::2]
+    acc /= 4
+    if np.issubdtype(img.dtype, np.integer):
+        np.round(acc, out=acc)
+    return acc.astype(img.dtype)
+
+
+def build_pyramid(img, min_size=MIN_LEVEL_SIZE):
+    """Return [img, img / 2, img / 4, ...] down to about min_size pixels."""
+    levels = [img]
+    while max(levels[-1].shape[:2]) > min_size:
+        levels.append(downsample(levels[-1]))
+    return levels
+
+
+def level_extent(level, scale):
+    """imshow extent placing a level in full-resolution pixel coordinates."""
+    height, width = level.shape[:2]
+    return (-0.5, width * scale - 0.5, height * scale - 0.5, -0.5)
+
+
+def choose_level(levels, ax):
+    """Index of the coarsest level still sharper than the screen pixels."""
+    x1, x2 = ax.get_xlim()
+    y1, y2 = ax.get_ylim()
+    bbox = ax.get_window_extent()
+    if bbox.width <= 0 or bbox.height <= 0:
+        return 0
+    ratio = max(abs(x2 - x1) / bbox.width, abs(y2 - y1) / bbox.height)
+    if ratio < 2:
+        return 0
+    return min(int(math.log2(ratio)), len(levels) - 1)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Recompute the statistics of samples whose source image has changed.
+
+Images under the image directory are matched to samples by file name.
+A sample is rescored when the content hash of its image differs from
+the one it was taken from, or when it has none. Hashes are cached in
+the image directory and only recomputed for files whose mtime or size
+changed. Samples of unchanged images are left untouched, as are superpixel and
+accumulated multi-patch samples, which only the GUI computes.
+
+    python resample.py samples.csv images/ -o resampled.csv
+    python resample.py ~/.digbird/samples.sqlite images/
+"""
+
+import argparse
+import csv
+import math
+import multiprocessing
+import os
+import sys
+
+import batch
+import fingerprint
+import sample
+import sample_db
+
+
+def find_images(directory):
+    """Map image file names below directory to (path, content hash)."""
+    fingerprints = fingerprint.FingerprintIndex(
+        os.path.join(directory, fingerprint.INDEX_FILE))
+    images = {}
+    for path in fingerprint.scan_images(directory):
+        name = os.path.basename(path)
+        if name in images:
+            sys.stderr.write('{}: duplicate of {}, ignored\n'.format(
+                path, images[name][0]))
+            continue
+        images[name] = (path, fingerprints.digest(path))
+    fingerprints.save()
+    return images
+
+
+def radius_from_size(size):
+    return int(round(math.sqrt(float(size)) / 2))
+
+
+def stale_groups(rows, images):
+    """Group the rows whose image changed by image path, as batch input."""
+    groups = {}
+    for key, row in enumerate(rows):
+        image = images.get(row['imgfile'])
+        if image is None or row.get('imghash') == image[1]:
+            continue
+        if row.get('method') not in (None, '', 'square'):
+            continue
+        if str(row.get('patches') or 1) != '1':
+            continue
+        point = dict(row, path=image[0], radius=radius_from_size(row['size']))
+        groups.setdefault(image[0], []).append((key, point))
+    return groups
+
+
+def resample(rows, images, jobs=None, spaces=batch.COLOUR_SPACES):
+    """Return {row number: rescored row} for the rows of changed images."""
+    groups = stale_groups(rows, images)
+    keys, points = {}, {}
+    for path, group in groups.items():
+        keys[path] = [key for key, _ in group]
+        points[path] = [point for _, point in group]
+    head = sample.Sample().get_csv_head()
+    result = {}
+    for path, lines in batch.score_groups(points, jobs, spaces):
+        if isinstance(lines, Exception):
+            sys.stderr.write('{}: {}\n'.format(path, lines))
+            continue
+        rescored = csv.DictReader([head] + lines)
+        result.update(zip(keys[path], rescored))
+    return result
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        'samples', help='CSV export or SQLite database (.sqlite) of samples')
+    parser.add_argument('images', help='directory with the source images')
+    parser.add_argument(
+        '-o', '--output',
+        help='output CSV file; a database is updated in place')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='worker processes (default: one per CPU)')
+    batch.add_spaces_argument(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    images = find_images(args.images)
+
+    if args.samples.lower().endswith('.sqlite'):
+        database = sample_db.SampleDatabase(args.samples)
+        rows = list(database.query(with_id=True))
+        rescored = resample(rows, images, args.jobs, args.spaces)
+        database.update(
+            dict(row, id=rows[key]['id']) for key, row in rescored.items())
+        database.close()
+    else:
+        if args.output is None:
+            sys.exit('an --output file is needed for CSV input')
+        with open(args.samples, newline='') as f:
+            rows = list(csv.DictReader(f))
+        rescored = resample(rows, images, args.jobs, args.spaces)
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(
+                f, sample.Sample().data.keys(), restval='',
+                extrasaction='ignore', lineterminator='\n')
+            writer.writeheader()
+            for key, row in enumerate(rows):
+                writer.writerow(rescored.get(key, row))
+
+    sys.stderr.write('rescored {} of {} samples\n'.format(
+        len(rescored), len(rows)))
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,123 @@
+import collections
+import csv
+import io
+
+import numpy as np
+
+import histograms
+import patch_stats
+
+STAT_NAMES = ('mean', 'std', 'min', 'max')
+# Decimals kept of each colour space; linear RGB is close to zero for
+# most colours and needs more
+DECIMALS = {'hsv': 2, 'lab': 2, 'linrgb': 4}
+
+
+def csv_line(values):
+    """One CSV line without terminator, quoted as csv.reader expects."""
+    f = io.StringIO()
+    csv.writer(f, lineterminator='').writerow(values)
+    return f.getvalue()
+
+
+def format_value(value):
+    """CSV text of a field; arrays become space separated numbers."""
+    if isinstance(value, np.ndarray):
+        return ' '.join(map(str, value.tolist()))
+    return str(value)
+
+
+class Sample(object):
+    def __init__(self):
+        self.data = collections.OrderedDict()
+        self.data['genus'] = ''
+        self.data['species'] = ''
+        self.data['subspecies'] = ''
+        self.data['plumreg'] = ''
+        self.data['sex'] = ''
+        self.data['age'] = ''
+        self.data['colcat'] = ''
+        self.data['imgfile'] = ''
+        # SHA-1 of the image file, to find samples of images changed since
+        self.data['imghash'] = ''
+        self.data['imgsrc'] = ''
+        self.data['imgtype'] = ''
+        self.data['x'] = 0
+        self.data['y'] = 0
+        self.data['size'] = 0
+        # 'square', 'superpixel' or 'merged superpixels'
+        self.data['method'] = 'square'
+        # Number of clicks accumulated into the sample
+        self.data['patches'] = 1
+        # Pixels the statistics were computed from
+        self.data['pixels'] = 0
+        # Statistics of every channel of every colour space, such as
+        # 'h_mean' or 'lab_l_std'
+        for channels in patch_stats.COLOUR_SPACES.values():
+            for name in STAT_NAMES:
+                for channel in channels:
+                    self.data['{}_{}'.format(channel, name)] = 0.0
+        # HSV percentiles, such as 'v_p95', and HSV histograms of
+        # histograms.HIST_BINS bins per channel, one after the other
+        for channel in 'hsv':
+            for q in histograms.PERCENTILES:
+                self.data['{}_p{:02d}'.format(channel, q)] = 0.0
+        self.data['hsv_hist'] = np.zeros(
+            3 * histograms.HIST_BINS, dtype=np.uint32)
+
+    def set_stats(self, stats, spaces=('hsv',)):
+        """Fill in PatchStats with the channels of spaces, in order."""
+        for i, space in enumerate(spaces):
+            channels = patch_stats.COLOUR_SPACES[space]
+            for name in STAT_NAMES:
+                values = np.around(getattr(stats, name)[3 * i:3 * i + 3],
+                                   decimals=DECIMALS[space])
+                for channel, value in zip(channels, values):
+                    self.data['{}_{}'.format(channel, name)] = value
+
+    def set_histogram(self, hist):
+        """Fill in the percentiles and histograms from index bin counts."""
+        values = np.around(histograms.percentiles(hist), decimals=2)
+        for channel, row in zip('hsv', values):
+            for q, value in zip(histograms.PERCENTILES, row):
+                self.data['{}_p{:02d}'.format(channel, q)] = value
+        self.data['hsv_hist'] = histograms.coarsen(hist).astype(
+            np.uint32).ravel()
+
+    def get_csv_head(self):
+        return csv_line(self.data.keys())
+
+    def get_csv(self):
+        return csv_line(map(format_value, self.data.values()))
+
+    def get_display(self):
+        result = []
+        display_items = [
+            'x',
+            'y',
+            'size',
+            'method',
+            'patches',
+            'pixels',
+            'h_mean',
+            's_mean',
+            'v_mean',
+            'h_std',
+            's_std',
+            'v_std',
+            'h_min',
+            's_min',
+            'v_min',
+            'h_max',
+            's_max',
+            'v_max',
+            'lab_l_mean',
+            'lab_a_mean',
+            'lab_b_mean',
+            'v_p05',
+            'v_p50',
+            'v_p95',
+        ]
+        for i in display_items:
+            result.append((i, self.data.get(i)))
+        return result
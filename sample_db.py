@@ -0,0 +1,129 @@
+import csv
+import sqlite3
+
+import numpy as np
+
+import sample_store
+
+# Two samples with the same key are the same click inserted twice
+UNIQUE_KEY = ('imgfile', 'x', 'y', 'size', 'plumreg')
+INDEXES = [
+    ('genus', 'species', 'subspecies'),
+    ('plumreg',),
+    ('imgfile',),
+]
+BATCH_SIZE = 1000
+
+
+def sql_values(schema, row):
+    """typed_values of row with arrays as raw bytes for BLOB columns."""
+    return tuple(
+        value.tobytes() if isinstance(value, np.ndarray) else value
+        for value in sample_store.typed_values(schema, row))
+
+
+def sql_type(dtype):
+    if dtype == sample_store.CATEGORY:
+        return 'TEXT'
+    if dtype.subdtype is not None:
+        return 'BLOB'
+    if dtype.kind == 'i':
+        return 'INTEGER'
+    return 'REAL'
+
+
+class SampleDatabase(object):
+    """SQLite database of samples, one column per Sample field."""
+
+    def __init__(self, file_name, schema=None):
+        self.file_name = file_name
+        self.schema = (
+            schema if schema is not None else sample_store.sample_schema())
+        self.connection = sqlite3.connect(file_name)
+        self.create()
+
+    def create(self):
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS samples ('
+                'id INTEGER PRIMARY KEY, {}, UNIQUE ({}))'.format(
+                    ', '.join('{} {}'.format(name, sql_type(dtype))
+                              for name, dtype in self.schema.items()),
+                    ', '.join(UNIQUE_KEY)))
+            # Databases created before a field was added to Sample
+            existing = {row[1] for row in self.connection.execute(
+                'PRAGMA table_info(samples)')}
+            for name, dtype in self.schema.items():
+                if name not in existing:
+                    self.connection.execute(
+                        'ALTER TABLE samples ADD COLUMN {} {}'.format(
+                            name, sql_type(dtype)))
+            for columns in INDEXES:
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS samples_{} '
+                    'ON samples ({})'.format(
+                        '_'.join(columns), ', '.join(columns)))
+
+    def insert(self, rows):
+        """Insert samples given as mappings, skipping duplicates.
+
+        Rows are written in transactions of BATCH_SIZE. Returns the number
+        of rows inserted and the number of duplicates skipped.
+        """
+        statement = 'INSERT OR IGNORE INTO samples ({}) VALUES ({})'.format(
+            ', '.join(self.schema), ', '.join('?' * len(self.schema)))
+        inserted = total = 0
+        batch = []
+        for row in rows:
+            batch.append(sql_values(self.schema, row))
+            if len(batch) >= BATCH_SIZE:
+                inserted += self._insert_batch(statement, batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            inserted += self._insert_batch(statement, batch)
+            total += len(batch)
+        return inserted, total - inserted
+
+    def _insert_batch(self, statement, batch):
+        before = self.connection.total_changes
+        with self.connection:
+            self.connection.executemany(statement, batch)
+        return self.connection.total_changes - before
+
+    def insert_csv(self, lines):
+        """Insert samples from CSV lines, the first of which is the header."""
+        return self.insert(csv.DictReader(lines))
+
+    def query(self, where='', params=(), with_id=False):
+        """Yield matching samples as mappings of field name to value.
+
+        where is an SQL condition such as 'genus = ? AND plumreg = ?'. With
+        with_id the row id is included under 'id', as used by update().
+        """
+        columns = (['id'] if with_id else []) + list(self.schema)
+        sql = 'SELECT {} FROM samples'.format(', '.join(columns))
+        if where:
+            sql += ' WHERE ' + where
+        for row in self.connection.execute(sql, params):
+            yield dict(zip(columns, row))
+
+    def update(self, rows):
+        """Overwrite the samples given as mappings that include their 'id'."""
+        statement = 'UPDATE samples SET {} WHERE id = ?'.format(
+            ', '.join('{} = ?'.format(name) for name in self.schema))
+        with self.connection:
+            self.connection.executemany(statement, (
+                sql_values(self.schema, row) + (row['id'],)
+                for row in rows
+            ))
+
+    def export(self, file_name, where='', params=()):
+        store = sample_store.SampleStore(self.schema)
+        for row in self.query(where, params):
+            store.append(row)
+        store.save(file_name)
+        return len(store)
+
+    def close(self):
+        self.connection.close()
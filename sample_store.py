@@ -0,0 +1,196 @@
+import collections
+import csv
+import os
+
+import numpy as np
+
+import sample
+
+CATEGORY = 'category'
+
+
+def sample_schema():
+    """Column types derived from the default values of Sample's fields.
+
+    Text fields become dictionary-encoded categories, integers int32,
+    arrays fixed-shape subarray types and everything else float32.
+    """
+    schema = collections.OrderedDict()
+    for name, value in sample.Sample().data.items():
+        if isinstance(value, np.ndarray):
+            schema[name] = np.dtype((value.dtype, value.shape))
+        elif isinstance(value, str):
+            schema[name] = CATEGORY
+        elif isinstance(value, (int, np.integer)):
+            schema[name] = np.dtype(np.int32)
+        else:
+            schema[name] = np.dtype(np.float32)
+    return schema
+
+
+def typed_values(schema, data):
+    """Yield data's values in schema order, converted to the column types.
+
+    Missing values, such as fields added to Sample after data was stored,
+    become empty strings, zeros or NaN. Arrays are read from CSV text,
+    as written by sample.format_value, or from SQLite blobs.
+    """
+    for name, dtype in schema.items():
+        value = data.get(name)
+        if dtype == CATEGORY:
+            yield '' if value is None else str(value)
+        elif dtype.subdtype is not None:
+            yield array_value(dtype, value)
+        elif dtype.kind == 'i':
+            yield 0 if value is None else int(value)
+        else:
+            yield float('nan') if value is None else float(value)
+
+
+def array_value(dtype, value):
+    base, shape = dtype.subdtype
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return np.zeros(shape, dtype=base)
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype=base).reshape(shape)
+    if isinstance(value, str):
+        value = value.split()
+    return np.asarray(value, dtype=base).reshape(shape)
+
+
+class SampleStore(object):
+    """Columnar, typed storage for many samples.
+
+    Numeric fields live in contiguous arrays; text fields are stored as
+    int32 codes into a per-column list of categories.
+    """
+
+    def __init__(self, schema=None, capacity=1024):
+        self.schema = schema if schema is not None else sample_schema()
+        self.size = 0
+        self.columns = collections.OrderedDict()
+        self.categories = {}
+        self.codes = {}
+        for name, dtype in self.schema.items():
+            if dtype == CATEGORY:
+                self.columns[name] = np.empty(capacity, dtype=np.int32)
+                self.categories[name] = []
+                self.codes[name] = {}
+            else:
+                self.columns[name] = np.empty(capacity, dtype=dtype)
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, size):
+        capacity = len(next(iter(self.columns.values())))
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name, column in self.columns.items():
+            grown = np.empty(
+                (capacity,) + column.shape[1:], dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    def encode(self, name, value):
+        codes = self.codes[name]
+        if value not in codes:
+            codes[value] = len(codes)
+            self.categories[name].append(value)
+        return codes[value]
+
+    def append(self, data):
+        """Append one sample given as a mapping of field name to value."""
+        self._reserve(self.size + 1)
+        values = typed_values(self.schema, data)
+        for name, value in zip(self.schema, values):
+            if name in self.codes:
+                value = self.encode(name, value)
+            self.columns[name][self.size] = value
+        self.size += 1
+
+    def extend_csv(self, lines):
+        """Append samples from CSV lines, the first of which is the header."""
+        for row in csv.DictReader(lines):
+            self.append(row)
+
+    def column(self, name):
+        values = self.columns[name][:self.size]
+        if self.schema[name] == CATEGORY:
+            return np.array(self.categories[name], dtype=object)[values]
+        return values
+
+    def rows(self):
+        columns = [self.column(name) for name in self.schema]
+        for i in range(self.size):
+            yield [column[i] for column in columns]
+
+    def save(self, file_name):
+        ext = os.path.splitext(file_name)[1].lower()
+        if ext == '.npz':
+            self.save_npz(file_name)
+        elif ext == '.parquet':
+            self.save_parquet(file_name)
+        else:
+            self.save_csv(file_name)
+
+    def save_csv(self, file_name):
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(self.schema)
+            for row in self.rows():
+                writer.writerow([sample.format_value(v) for v in row])
+
+    def save_npz(self, file_name):
+        arrays = {}
+        for name, column in self.columns.items():
+            arrays[name] = column[:self.size]
+            if name in self.categories:
+                arrays[name + '.categories'] = np.array(
+                    self.categories[name], dtype=str)
+        np.savez_compressed(file_name, **arrays)
+
+    def save_parquet(self, file_name):
+        # pyarrow is only needed for this export format
+        import pyarrow
+        import pyarrow.parquet
+
+        arrays = []
+        for name, column in self.columns.items():
+            values = column[:self.size]
+            if name in self.categories:
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                    values, pyarrow.array(self.categories[name],
+                                          type=pyarrow.string())))
+            elif values.ndim > 1:
+                # Array fields become fixed-size list columns
+                arrays.append(pyarrow.FixedSizeListArray.from_arrays(
+                    pyarrow.array(values.ravel()), values.shape[1]))
+            else:
+                arrays.append(pyarrow.array(values))
+        table = pyarrow.Table.from_arrays(arrays, names=list(self.columns))
+        pyarrow.parquet.write_table(table, file_name)
+
+    @classmethod
+    def load_npz(cls, file_name):
+        with np.load(file_name) as npz:
+            schema = collections.OrderedDict()
+            for name in npz.files:
+                if name.endswith('.categories'):
+                    continue
+                if name + '.categories' in npz.files:
+                    schema[name] = CATEGORY
+                else:
+                    array = npz[name]
+                    schema[name] = np.dtype((array.dtype, array.shape[1:]))
+            store = cls(schema, capacity=0)
+            for name in schema:
+                store.columns[name] = npz[name]
+                store.size = len(npz[name])
+                if schema[name] == CATEGORY:
+                    store.categories[name] = [
+                        str(c) for c in npz[name + '.categories']]
+                    store.codes[name] = {
+                        c: i for i, c in enumerate(store.categories[name])}
+        return store
@@ -0,0 +1,8 @@
+"""Time of process start, taken before main imports Qt and matplotlib.
+
+main imports this module first, so that startup profiling covers the
+imports without any code above them.
+"""
+import time
+
+STARTUP_CLOCK = time.perf_counter()
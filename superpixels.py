@@ -0,0 +1,220 @@
+import collections
+import os
+
+import numpy as np
+
+import histograms
+import patch_stats
+import plane_cache
+
+CACHE_DIR = os.path.expanduser('~/.digbird/segments')
+# Least recently used files are removed beyond this total size; an image
+# takes about 5 MB
+CACHE_BYTES = 1024 ** 3
+# Segmentation runs on the first pyramid level at most this large
+MAX_SEGMENT_SIZE = 1024
+# Rows of the full image reduced at once when building the table
+CHUNK_ROWS = 256
+
+SegmentTable = collections.namedtuple('SegmentTable', [
+    'labels', 'scale', 'count', 'sum', 'sumsq', 'min', 'max', 'rgb_mean',
+    'hist', 'neighbours',
+])
+
+
+def choose_level(levels, max_size=MAX_SEGMENT_SIZE):
+    for k, level in enumerate(levels):
+        if max(level.shape[:2]) <= max_size:
+            return k
+    return len(levels) - 1
+
+
+def segment(rgb, n_segments, compactness):
+    import skimage.segmentation
+    return skimage.segmentation.slic(
+        rgb, n_segments=n_segments, compactness=compactness,
+        start_label=0).astype(np.int32)
+
+
+def load_labels(levels, digest, n_segments, compactness, directory=CACHE_DIR):
+    """SLIC labels of a pyramid level, cached on disk by content hash.
+
+    Returns the labels and the scale from label to full-image pixels.
+    """
+    k = choose_level(levels)
+    file_name = os.path.join(directory, '{}-{}-{}-{}.npy'.format(
+        digest, n_segments, compactness, k))
+    try:
+        labels = np.load(file_name)
+        touch(file_name)
+    except (OSError, ValueError):
+        labels = segment(levels[k], n_segments, compactness)
+        os.makedirs(directory, exist_ok=True)
+        tmp_file = '{}.{}.tmp.npy'.format(file_name[:-4], os.getpid())
+        np.save(tmp_file, labels)
+        os.replace(tmp_file, file_name)
+    return labels, 2 ** k
+
+
+def touch(file_name):
+    # The file's mtime marks its last use for prune()
+    try:
+        os.utime(file_name)
+    except OSError:
+        pass
+
+
+def prune(directory=CACHE_DIR, max_bytes=CACHE_BYTES):
+    """Remove the least recently used files beyond max_bytes in total."""
+    files = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and '.tmp.' not in entry.name:
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def full_labels(labels, scale, rows, width):
+    """Labels of the given full-image rows, upsampled from the level."""
+    return labels[np.arange(rows.start, rows.stop) // scale][
+        :, np.arange(width) // scale]
+
+
+def neighbour_pairs(labels):
+    """Unique (a, b) pairs, a < b, of labels sharing an edge."""
+    pairs = np.concatenate([
+        np.stack([labels[:, :-1].ravel(), labels[:, 1:].ravel()], axis=1),
+        np.stack([labels[:-1].ravel(), labels[1:].ravel()], axis=1),
+    ])
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return np.unique(np.sort(pairs, axis=1), axis=0)
+
+
+def segment_table(labels, scale, rgb, hsv, extra_spaces=()):
+    """Per-segment statistics of the full image.
+
+    The statistics cover the quantized HSV planes, as cached by
+    plane_cache, followed by extra_spaces converted from rgb. Sums, sums
+    of squares, extremes and HSV histograms are accumulated with bincount
+    and ufunc.at label reductions over blocks of rows, so that clicks only
+    look segments up.
+    """
+    height, width = rgb.shape[:2]
+    n = int(labels.max()) + 1
+    c = 3 + 3 * len(extra_spaces)
+    count = np.zeros(n, dtype=np.int64)
+    sums = np.zeros((n, c))
+    sumsq = np.zeros((n, c))
+    mins = np.full((n, c), np.inf)
+    maxs = np.full((n, c), -np.inf)
+    rgb_sums = np.zeros((n, 3))
+    hist = np.zeros((n, 3, histograms.INDEX_BINS), dtype=np.int64)
+    hist_size = 3 * histograms.INDEX_BINS
+
+    for start in range(0, height, CHUNK_ROWS):
+        rows = slice(start, min(start + CHUNK_ROWS, height))
+        flat = full_labels(labels, scale, rows, width).ravel()
+        pixels = np.concatenate([
+            plane_cache.dequantize(hsv[rows]),
+            patch_stats.to_colour_spaces(rgb[rows], extra_spaces),
+        ], axis=-1).reshape(-1, c)
+        # One bincount over (label, channel) bins covers all channels
+        bins = (flat[:, np.newaxis] * c + np.arange(c)).ravel()
+        count += np.bincount(flat, minlength=n)
+        sums += np.bincount(bins, pixels.ravel(), n * c).reshape(n, c)
+        sumsq += np.bincount(
+            bins, np.square(pixels).ravel(), n * c).reshape(n, c)
+        rgb_bins = (flat[:, np.newaxis] * 3 + np.arange(3)).ravel()
+        rgb_sums += np.bincount(
+            rgb_bins, rgb[rows].reshape(-1).astype(np.float64),
+            n * 3).reshape(n, 3)
+        hist_bins = (
+            flat[:, np.newaxis] * hist_size +
+            np.arange(3) * histograms.INDEX_BINS +
+            histograms.to_bins(hsv[rows]).reshape(-1, 3)).ravel()
+        hist += np.bincount(
+            hist_bins, minlength=n * hist_size).reshape(hist.shape)
+        np.minimum.at(mins, flat, pixels)
+        np.maximum.at(maxs, flat, pixels)
+
+    rgb_mean = rgb_sums / np.maximum(count, 1)[:, np.newaxis]
+    return SegmentTable(
+        labels, scale, count, sums, sumsq, mins, maxs, rgb_mean, hist,
+        neighbour_pairs(labels))
+
+
+def load_segments(levels, digest, hsv, n_segments, compactness,
+                  extra_spaces=(), directory=CACHE_DIR,
+                  cancelled=lambda: False):
+    """segment_table of an image, cached on disk next to its labels.
+
+    levels is the image pyramid, whose first level is the full image.
+    Returns None when cancelled() reports that it is no longer wanted.
+    The table is stored without its labels, which load_labels caches.
+    """
+    labels, scale = load_labels(
+        levels, digest, n_segments, compactness, directory)
+    file_name = os.path.join(directory, '{}-{}-{}-{}-{}.npz'.format(
+        digest, n_segments, compactness, choose_level(levels),
+        '-'.join(('hsv',) + tuple(extra_spaces))))
+    try:
+        with np.load(file_name) as npz:
+            fields = {name: npz[name] for name in SegmentTable._fields
+                      if name != 'labels'}
+        touch(file_name)
+        fields.update(labels=labels, scale=scale)
+        return SegmentTable(**fields)
+    except (OSError, ValueError, KeyError):
+        pass
+    if cancelled():
+        return None
+    table = segment_table(labels, scale, levels[0], hsv, extra_spaces)
+    fields = table._asdict()
+    del fields['labels']
+    tmp_file = '{}.{}.tmp.npz'.format(file_name[:-4], os.getpid())
+    np.savez(tmp_file, **fields)
+    os.replace(tmp_file, file_name)
+    try:
+        prune(directory)
+    except OSError:
+        pass
+    return table
+
+
+def select(table, x, y, threshold=None):
+    """Segment under (x, y), plus neighbours closer than threshold.
+
+    Neighbours are merged when the distance between their mean colours
+    and that of the clicked segment, in 0-255 RGB, is below threshold.
+    """
+    label = table.labels[y // table.scale, x // table.scale]
+    selected = [label]
+    if threshold is not None:
+        pairs = table.neighbours
+        others = np.concatenate([
+            pairs[pairs[:, 0] == label, 1], pairs[pairs[:, 1] == label, 0]])
+        distance = np.linalg.norm(
+            table.rgb_mean[others] - table.rgb_mean[label], axis=1)
+        selected.extend(others[distance < threshold])
+    return np.array(selected)
+
+
+def selection_stats(table, selected):
+    """Combined PatchStats, mean 0-1 RGB and HSV histogram of segments."""
+    count = table.count[selected].sum()
+    mean = table.sum[selected].sum(axis=0) / count
+    var = table.sumsq[selected].sum(axis=0) / count - mean ** 2
+    rgb = (table.rgb_mean[selected] *
+           table.count[selected, np.newaxis]).sum(axis=0) / count / 255
+    stats = patch_stats.PatchStats(
+        count, mean, np.sqrt(np.maximum(var, 0)),
+        table.min[selected].min(axis=0), table.max[selected].max(axis=0))
+    return stats, rgb, table.hist[selected].sum(axis=0)
@@ -0,0 +1,64 @@
+import concurrent.futures
+import os
+
+import matplotlib.image as mpimg
+
+import fingerprint
+import image_io
+
+CACHE_DIR = os.path.expanduser('~/.digbird/thumbnails')
+THUMBNAIL_SIZE = 128
+
+
+def thumbnail_file(directory, digest):
+    # Spread over subdirectories to keep folders of 20k images browsable
+    return os.path.join(directory, digest[:2], digest + '.png')
+
+
+def build_thumbnail(path, digest=None, directory=CACHE_DIR,
+                    size=THUMBNAIL_SIZE):
+    """Write the thumbnail of path unless cached, hashing it if needed.
+
+    Runs in worker processes. Returns the content hash and the thumbnail
+    file.
+    """
+    if digest is None:
+        digest = fingerprint.file_sha1(path)
+    file_name = thumbnail_file(directory, digest)
+    if not os.path.exists(file_name):
+        preview = image_io.read_preview(path, size)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        tmp_file = '{}.{}.tmp.png'.format(file_name[:-4], os.getpid())
+        mpimg.imsave(tmp_file, preview)
+        os.replace(tmp_file, file_name)
+    return digest, file_name
+
+
+class ThumbnailBuilder(object):
+    """Builds thumbnails on a pool of worker processes, on request.
+
+    Content hashes computed by the workers are recorded in fingerprints,
+    so that unchanged images are never hashed twice.
+    """
+
+    def __init__(self, fingerprints, directory=CACHE_DIR,
+                 size=THUMBNAIL_SIZE, jobs=None):
+        self.fingerprints = fingerprints
+        self.directory = directory
+        self.size = size
+        self.executor = concurrent.futures.ProcessPoolExecutor(jobs)
+
+    def request(self, path):
+        """Future of the (digest, thumbnail file) of path."""
+        future = self.executor.submit(
+            build_thumbnail, path, self.fingerprints.cached(path),
+            self.directory, self.size)
+        future.add_done_callback(lambda f: self._done(path, f))
+        return future
+
+    def _done(self, path, future):
+        if not future.cancelled() and future.exception() is None:
+            self.fingerprints.record(path, future.result()[0])
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)